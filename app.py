@@ -1,23 +1,42 @@
-from flask import Flask, render_template, request, jsonify
-import requests
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
+import io
 import json
+import logging
 import os
 import random
-import ollama
+import re
 from datetime import datetime, timedelta
 from dateutil import parser
-from math import radians, cos, sin, sqrt, atan2
-import joblib
 import sqlite3
-from contextlib import contextmanager
-import joblib
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import contextvars
+import time as time_module
+from collections import namedtuple
 import numpy as np
-import pandas as pd
-import os
 from dotenv import load_dotenv
+from database import Database
+from sensor_ingest import ingest_sensor_records, read_csv, read_ndjson
+from crowd_engine import CrowdForecastEngine
+from crowd_heatmap import HORIZON_DAYS, CrowdHeatmap
+from crowd_models import CrowdModelRegistry, load_sensor_series
+from caching import TTLCache
+from chat_sessions import SLOTS, SessionStore
+from geocode_store import GeocodeStore
+from llm_scheduler import CLASSIFY, LLMBusy
+import prompts
+from route_cache import RouteCache, decode_polyline
+from providers import providers_from_env
+from route_search import SiteCatalog
+from spatial_index import GeoGridIndex
+from telemetry import cache_metrics, render_metrics, request_duration, span, start_trace, traced
+from upstream import UpstreamError, breaker_metrics
 
 load_dotenv() 
+logger = logging.getLogger(__name__)
 GOOGLE_MAPS_API = os.getenv("GOOGLE_MAPS_API")
+# Google Maps, Open-Meteo and Ollama, live or recorded/stubbed (see providers.py)
+providers = providers_from_env(GOOGLE_MAPS_API)
 
 app = Flask(__name__)
 
@@ -25,44 +44,17 @@ app = Flask(__name__)
 # Database configuration
 DATABASE_PATH = 'tourism_database.db'
 
+db = Database(DATABASE_PATH)
+
 # Database helper functions
-@contextmanager
 def get_db_connection():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row  # This allows accessing columns by name
-    try:
-        yield conn
-    finally:
-        conn.close()
+    """Context manager for database connections (a persistent connection per thread)"""
+    return db.connection()
 
 def init_database():
-    """Initialize the database and create tables"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Create less_known_sites table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS less_known_sites (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                site_name TEXT NOT NULL UNIQUE,
-                category TEXT NOT NULL,
-                description TEXT NOT NULL
-            )
-        ''')
-
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS collected_data_from_sensors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT NOT NULL,
-            hour TEXT NOT NULL,
-            site_name TEXT NOT NULL,
-            count INTEGER NOT NULL
-        )
-    ''')
-        
-        conn.commit()
-        print("Database initialized successfully!")
+    """Initialize the database: create tables and apply pending schema migrations"""
+    applied = db.migrate()
+    logger.info("Database initialized successfully! (schema version %s, %s migrations applied)", db.schema_version(), applied)
 
 def get_all_sites():
     """Get all sites from the database"""
@@ -83,48 +75,113 @@ def get_sensor_data_by_site(site_name):
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            'SELECT * FROM collected_data_from_sensors WHERE site_name = ?',
+            'SELECT * FROM collected_data_from_sensors WHERE site_name = ? ORDER BY date, hour',
             (site_name,)
         )
         return cursor.fetchall()
 
-def add_site(site_name, category, description):
-    """Add a new site to the database"""
+def geocode_site(site_name):
+    """Coordinates of a site for the latitude/longitude columns, (None, None) if unknown"""
+    try:
+        return get_coordinates(site_name)
+    except Exception as e:
+        logger.warning("Could not geocode %s: %s", site_name, e)
+        return None, None
+
+def index_site(row):
+    """Add or move a database row of less_known_sites in the spatial index"""
+    site_index.upsert({
+        'id': row['id'], 'site_name': row['site_name'], 'category': row['category'],
+        'latitude': row['latitude'], 'longitude': row['longitude'],
+    })
+
+def parse_coordinates(latitude, longitude):
+    """(latitude, longitude) as floats, (None, None) when either is missing, raises ValueError when invalid"""
+    if latitude is None or longitude is None:
+        return None, None
+    try:
+        if isinstance(latitude, bool) or isinstance(longitude, bool):
+            raise TypeError
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError('latitude and longitude must be numbers')
+    # NaN fails the comparisons too
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('latitude/longitude out of range')
+    return latitude, longitude
+
+def add_site(site_name, category, description, latitude=None, longitude=None):
+    """Add a new site to the database, raises ValueError for invalid coordinates"""
+    latitude, longitude = parse_coordinates(latitude, longitude)
+    if latitude is None or longitude is None:
+        latitude, longitude = geocode_site(site_name)
     with get_db_connection() as conn:
         cursor = conn.cursor()
         try:
             cursor.execute(
-                'INSERT INTO less_known_sites (site_name, category, description) VALUES (?, ?, ?)',
-                (site_name, category, description)
+                'INSERT INTO less_known_sites (site_name, category, description, latitude, longitude) VALUES (?, ?, ?, ?, ?)',
+                (site_name, category, description, latitude, longitude)
             )
+            version = written_sites_version(conn)
             conn.commit()
+            index_site({'id': cursor.lastrowid, 'site_name': site_name, 'category': category,
+                        'latitude': latitude, 'longitude': longitude})
+            note_site_writes(version, 1)
             return True, "Site added successfully!"
         except sqlite3.IntegrityError:
             return False, "Site already exists!"
 
 def add_sensor_data(date, hour, site_name, count):
-    """Add a new sensor data entry to the database"""
+    """Add a new sensor data entry to the database (replaces an existing reading of that hour)"""
+    ingest_sensor_data([(1, {'date': date, 'hour': hour, 'site_name': site_name, 'count': count})])
+    return True
+
+def ingest_sensor_data(records):
+    """Bulk upsert of (line number, record) pairs, see sensor_ingest.ingest_sensor_records"""
+    stats = ingest_sensor_records(db, records, on_chunk=observe_sensor_rows)
+    if stats["written"]:
+        crowd_heatmap.notify()
+    return stats
+
+def observe_sensor_rows(rows):
+    """Feed freshly written (date, hour, site_name, count) rows to the live crowd buffers"""
+    # an engine that isn't loaded has no buffers yet, loading seeds them from the table (fill_db never loads it)
+    if not crowd_engine.loaded:
+        return
+    # rows come out of normalize_sensor_row as YYYY-MM-DD and HH:00, cheaper to slice than strptime
+    crowd_engine.observe_many([(site_name, datetime(int(date[:4]), int(date[5:7]), int(date[8:10]), int(hour[:2])), count)
+                               for date, hour, site_name, count in rows])
+
+def update_site(site_id, site_name, category, description, latitude=None, longitude=None):
+    """Update an existing site, raises ValueError for invalid coordinates.
+
+    Without new coordinates the stored ones are kept, a renamed site is geocoded
+    again and keeps its old coordinates if that fails.
+    """
+    latitude, longitude = parse_coordinates(latitude, longitude)
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            '''
-            INSERT INTO collected_data_from_sensors (date, hour, site_name, count)
-            VALUES (?, ?, ?, ?)
-            ''',
-            (date, hour, site_name, count)
-        )
-        conn.commit()
-        return True
-
-def update_site(site_id, site_name, category, description):
-    """Update an existing site"""
+        old = conn.execute('SELECT site_name, latitude, longitude FROM less_known_sites WHERE id = ?',
+                           (site_id,)).fetchone()
+    if old is None:
+        return False
+    if latitude is None or longitude is None:
+        if site_name != old['site_name']:
+            latitude, longitude = geocode_site(site_name)
+        if latitude is None or longitude is None:
+            latitude, longitude = old['latitude'], old['longitude']
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            'UPDATE less_known_sites SET site_name = ?, category = ?, description = ? WHERE id = ?',
-            (site_name, category, description, site_id)
+            'UPDATE less_known_sites SET site_name = ?, category = ?, description = ?, latitude = ?, longitude = ? WHERE id = ?',
+            (site_name, category, description, latitude, longitude, site_id)
         )
+        version = written_sites_version(conn)
         conn.commit()
+        if cursor.rowcount > 0:
+            site_index.remove(old['site_name'])
+            index_site({'id': site_id, 'site_name': site_name, 'category': category,
+                        'latitude': latitude, 'longitude': longitude})
+            note_site_writes(version, cursor.rowcount)
         return cursor.rowcount > 0
 
 def delete_site(site_name):
@@ -132,7 +189,10 @@ def delete_site(site_name):
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM less_known_sites WHERE site_name = ?', (site_name,))
+        version = written_sites_version(conn)
         conn.commit()
+        site_index.remove(site_name)
+        note_site_writes(version, cursor.rowcount)
         return cursor.rowcount > 0
 
 def clear_sites_table():
@@ -140,134 +200,339 @@ def clear_sites_table():
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('DELETE FROM less_known_sites')
+        version = written_sites_version(conn)
         conn.commit()
+        site_index.rebuild([])
+        note_site_writes(version, cursor.rowcount)
+
+def load_site_index():
+    """Fill the spatial index with every site that has coordinates"""
+    site_index.rebuild(
+        {'id': row['id'], 'site_name': row['site_name'], 'category': row['category'],
+         'latitude': row['latitude'], 'longitude': row['longitude']}
+        for row in get_all_sites()
+    )
 
-# Initialize database on startup
-init_database()
+def backfill_site_coordinates():
+    """Store coordinates for sites added before the latitude/longitude columns existed"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM less_known_sites WHERE latitude IS NULL OR longitude IS NULL')
+        rows = cursor.fetchall()
+        updated = 0
+        for row in rows:
+            lat, lon = geocode_site(row['site_name'])
+            if lat is None:
+                continue
+            cursor.execute('UPDATE less_known_sites SET latitude = ?, longitude = ? WHERE id = ?', (lat, lon, row['id']))
+            updated += cursor.rowcount
+            index_site({'id': row['id'], 'site_name': row['site_name'], 'category': row['category'],
+                        'latitude': lat, 'longitude': lon})
+        version = written_sites_version(conn)
+        conn.commit()
+        note_site_writes(version, updated)
+
+# in-memory index over the site coordinates, kept in sync by the helpers above,
+# filled by create_app() and rebuilt by sync_site_index() after writes from other processes
+site_index = GeoGridIndex()
+site_index_state = {"version": None}  # sites_version the index was last rebuilt at
+site_index_lock = threading.Lock()
+
+def sync_site_index(version=None):
+    """Rebuild the spatial index if less_known_sites changed since it was built, by any worker or fill_db"""
+    if version is None:
+        version = route_cache.sites_version()
+    with site_index_lock:
+        if site_index_state["version"] != version:
+            # version was read before the rows, the index is at least as new as what it records
+            load_site_index()
+            site_index_state["version"] = version
+
+def written_sites_version(conn):
+    """sites_version as left by the uncommitted write on conn, read before the commit so no other write is counted"""
+    return conn.execute("SELECT value FROM app_meta WHERE key = 'sites_version'").fetchone()[0]
+
+def note_site_writes(version, changes):
+    """Record a write of this worker, already applied to the index in place, so sync_site_index doesn't rebuild for it.
+
+    version is written_sites_version() of the write, every changed row bumped it
+    once; if the index was behind before the write it stays behind and is rebuilt.
+    """
+    if not changes:
+        return
+    with site_index_lock:
+        if site_index_state["version"] == version - changes:
+            site_index_state["version"] = version
 #___________________________________________________________________
 
 
-if os.path.exists("location_cache.json"):
-    with open("location_cache.json", "r") as f:
-        location_cache = json.load(f)
-else:
-    location_cache = {}
+# Geocoding results live in the geocode_cache table so every worker process shares them,
+# entries of the old location_cache.json are imported into it by create_app()
+geocode_store = GeocodeStore(db)
+
+
+def model_messages(prompt, role="user"):
+    # every call shares prompts.SYSTEM_PROMPT, so Ollama reuses the evaluated prefix
+    return prompts.messages(prompt, role)
 
 
-def run_model(prompt, role="user"):
-    print('run_model function entered')
-    response = ollama.chat(model='llama3', messages=[
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": role, "content": prompt}
-    ])
-    print(response)
+@traced("llm")
+def run_model(prompt, role="user", format=None, priority=None):
+    # format='json' turns on Ollama's JSON mode, the reply is then always a JSON document.
+    # priority orders calls waiting for the LLM (see llm_scheduler), JSON answers default to CLASSIFY
+    logger.debug('run_model function entered')
+    response = providers.chat(model_messages(prompt, role), format=format, priority=priority)
+    logger.debug("run_model response: %s", response)
     return response['message']['content']
 
 
+def stream_model(prompt, role="user"):
+    """Like run_model, but yields the answer piece by piece while llama3 generates it"""
+    logger.debug('stream_model function entered')
+    stream = providers.chat_stream(model_messages(prompt, role))
+    for chunk in stream:
+        token = chunk['message']['content']
+        if token:
+            yield token
+
+
+@traced("extract_field")
 def extract_info_using_llm(field, user_input):
-    prompt = f"""
-    You are an information extractor, I will give you a sentence and your job is to extract information from that sentence.
-    "{user_input}" What is the user's {field}?
-    Just answer with the {field} alone with no explanation. If not specified, say "None".
-    """
-    print(f"extract_info_using_llm is entered with field = {field}")
-    print("from extract_info_using_llm, run_model will be entered")
-    response = run_model(prompt)
+    prompt = prompts.render("extract_field", user_input=user_input, field=field)
+    logger.debug("extract_info_using_llm is entered with field = %s", field)
+    logger.debug("from extract_info_using_llm, run_model will be entered")
+    response = run_model(prompt, priority=CLASSIFY)
     if 'None' in response: return None
-    print(response)
+    logger.debug("Extracted %s: %s", field, response)
     return response.strip()
 
+# Crowd model, scaler and count series are loaded once (by warm_up() or the first
+# prediction) and kept in memory, the engine reloads them by itself when the files change on disk
+# Sites with a trained model in crowd_models/ (python crowd_models.py) are forecast from
+# their latest sensor readings, the others keep using the Petra model
+crowd_registry = CrowdModelRegistry()
+crowd_engine = CrowdForecastEngine(registry=crowd_registry,
+                                   load_recent=lambda hours, sites: load_sensor_series(db, sites, limit_per_site=hours))
+# the engine's hourly forecasts for the coming days, materialized in the crowd_forecast table
+crowd_heatmap = CrowdHeatmap(db, crowd_engine)
+MAX_HEATMAP_DAYS = 31
+
+# visiting hours used when looking for a better time slot
+OPENING_HOUR = 6
+CLOSING_HOUR = 18
+
+TRIP_FIELDS = ("current_location", "visit_time", "destination")
+EXTRACTION_RETRIES = 2
+
+def clean_trip_value(value):
+    """A stripped extracted value, None for the ways the model says there is none"""
+    value = (value or "").strip()
+    return None if value.lower() in ("", "none", "null", "unknown", "n/a") else value
+
+def parse_visit_time(value):
+    """The clock time of an extracted visit_time, None when it isn't one"""
+    try:
+        return parser.parse(value).time()
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def parse_trip_info(raw):
+    """Validate the JSON answer of the extractor, returns (info, error)"""
+    try:
+        data = json.loads(raw)
+    except (TypeError, ValueError):
+        return None, "the answer was not valid JSON"
+    if not isinstance(data, dict):
+        return None, "the answer must be a JSON object"
+
+    missing = [key for key in ("on_topic",) + TRIP_FIELDS if key not in data]
+    if missing:
+        return None, f"the answer is missing the keys {missing}"
+
+    info = {}
+    for field in TRIP_FIELDS:
+        value = data[field]
+        if value is not None and not isinstance(value, str):
+            return None, f"'{field}' must be a string or null"
+        info[field] = clean_trip_value(value)
+
+    if info["visit_time"] is not None and parse_visit_time(info["visit_time"]) is None:
+        return None, f"'visit_time' must be a clock time like '10:00 AM', got '{info['visit_time']}'"
+
+    on_topic = data["on_topic"]
+    if isinstance(on_topic, str):
+        on_topic = on_topic.strip().lower() in ("true", "yes")
+    # a message that carries any of the details is on topic whatever the model said
+    info["on_topic"] = bool(on_topic) or any(info[field] for field in TRIP_FIELDS)
+    return info, None
+
+
+def trip_extraction_prompt(user_input):
+    return prompts.render("trip_extraction", user_input=user_input)
+
+def extraction_retry_prompt(prompt, error):
+    return prompt + prompts.render("extraction_retry", error=error)
+
+@traced("extract")
+def extract_trip_info(user_input):
+    """Off-topic check and location/time/destination extraction in one LLM call"""
+    prompt = trip_extraction_prompt(user_input)
+    retry_prompt = prompt
+    for attempt in range(EXTRACTION_RETRIES + 1):
+        response = run_model(retry_prompt, format='json')
+        info, error = parse_trip_info(response)
+        if info is not None:
+            logger.debug("Extracted trip info: %s", info)
+            return info
+        logger.warning("Bad extractor output (attempt %s): %s", attempt + 1, error)
+        retry_prompt = extraction_retry_prompt(prompt, error)
+
+    # the model kept answering in the wrong shape, fall back to one question per field
+    logger.warning("Falling back to per-field extraction")
+    return extract_trip_info_per_field(user_input)
+
+def extract_trip_info_per_field(user_input):
+    """Same shape and rules as parse_trip_info, a visit time that isn't a clock time counts as not given"""
+    info = {
+        "current_location": clean_trip_value(extract_info_using_llm('current location', user_input)),
+        "visit_time": clean_trip_value(extract_info_using_llm('visit time', user_input)),
+        "destination": clean_trip_value(extract_info_using_llm('destination', user_input)),
+    }
+    if info["visit_time"] is not None and parse_visit_time(info["visit_time"]) is None:
+        logger.debug("Dropping visit time that is not a clock time: %s", info["visit_time"])
+        info["visit_time"] = None
+    info["on_topic"] = not is_off_topic(user_input) or any(info[field] for field in TRIP_FIELDS)
+    return info
+
+@traced("crowd")
 def predict_crowd(site,time):
     if isinstance(time, str):  # If it's a string, parse it
         time = datetime.fromisoformat(time)
     date = datetime.today().date()
     visit_datetime = datetime.combine(date, time.time() if isinstance(time, datetime) else time)
-    model = joblib.load("linear_regression_petramodel.pkl")
-    scaler = joblib.load("scaler.pkl")
-
-    df = pd.read_csv("petra_counts_to_august.csv", parse_dates=['datetime'])
-    df['scaled_count'] = scaler.transform(df[['count']])
-    idx = df.index[df['datetime'] == visit_datetime]
-    idx = idx[0]
-    n_hours = 24
-    X_input = df['scaled_count'].iloc[idx - n_hours:idx].values.reshape(1, -1)
-    pred_scaled = model.predict(X_input)[0]
-    prediction = scaler.inverse_transform([[pred_scaled]])[0, 0]
-
-    if prediction >= 80:  # Peak hours
-        return "High"
-    elif prediction < 10:
-        return "Low"
-    else:
-        return "Moderate"
-
-def save_location_cache():
-    with open("location_cache.json", "w") as f:
-        json.dump(location_cache, f)
-
-
+    return crowd_engine.predict_level(visit_datetime, site)
+
+@traced("crowd_day")
+def predict_crowd_day(site, date):
+    """Hourly crowd forecast for a whole day, read from the crowd heatmap (computed once if it isn't there)"""
+    if isinstance(date, str):
+        date = datetime.fromisoformat(date).date()
+    elif isinstance(date, datetime):
+        date = date.date()
+    return crowd_heatmap.day(site, date)
+
+def best_crowd_slot(forecast, start_hour=OPENING_HOUR, end_hour=CLOSING_HOUR):
+    """The least crowded hour between start_hour and end_hour (inclusive)"""
+    candidates = [f for f in forecast if start_hour <= f["hour"] <= end_hour and f["count"] is not None]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda f: f["count"])
+
+@traced("geocode")
 def get_coordinates(site):
-    print("get_coordinates entered")
+    logger.debug("get_coordinates entered")
     site = site.lower().strip()
-    print(f"[DEBUG] Fetching coordinates for site: {site}")
-    if site in location_cache:
-        print(f"[DEBUG] Found in cache: {location_cache[site]}")
-        return location_cache[site] #to reduce api calls
+    logger.debug("Fetching coordinates for site: %s", site)
+    hit, coords = geocode_store.get(site)
+    if hit:
+        logger.debug("Found in cache: %s", coords)
+        return coords if coords else (None, None) #to reduce api calls
     
-    url = "https://maps.googleapis.com/maps/api/geocode/json"
-    params = {
-        "address": site,
-        "key": GOOGLE_MAPS_API
-    }
-    response = requests.get(url, params=params).json()
+    return remember_geocode(site, providers.geocode(site))
 
+def remember_geocode(site, response):
+    """Store a Geocoding API answer for site, returns its (lat, lon) or (None, None)"""
     if response["status"] == "OK":
         location = response["results"][0]["geometry"]["location"]
         lat, lon = location["lat"], location["lng"]
-        location_cache[site] = (lat, lon)
-        save_location_cache()
+        geocode_store.put(site, (lat, lon))
         return lat,lon
+    if response["status"] == "ZERO_RESULTS":
+        geocode_store.put(site, None) # remember that google doesn't know this place
     return None, None
 
 
-def get_todays_weather(site):
-    print("get_todays_weather entered")
-    lat, lon = get_coordinates(site)
-    url = (
-        "https://api.open-meteo.com/v1/forecast"
-        f"?latitude={lat}&longitude={lon}"
-        "&hourly=temperature_2m,weathercode"
-        "&timezone=auto"
-    )
-    response = requests.get(url)
-    data = response.json()
-    print(f"[DEBUG] Weather API called for {site} (lat: {lat}, lon: {lon})")
-    times = data['hourly']['time']
-    temps = data['hourly']['temperature_2m']
-    codes = data['hourly']['weathercode']
+def warm_geocode_store():
+    """Resolve coordinates of every lesser-known site ahead of the first chat"""
+    sites = [site['site_name'] for site in get_all_sites()]
+    if GOOGLE_MAPS_API or providers.offline:
+        resolved = geocode_store.warm(sites, get_coordinates)
+        logger.info("Geocode cache warmed, %s of %s sites had to be resolved", resolved, len(sites))
+    else:
+        geocode_store.load_all()
+    backfill_site_coordinates()
 
-    return times, temps, codes
 
+# Open-Meteo refreshes its hourly forecast about once an hour, so a forecast is kept
+# until the next full hour. Keyed by a ~1km coordinate grid and the local date, so
+# every chat about the same site (and nearby spellings of it) shares one upstream call.
+WEATHER_GRID_DECIMALS = 2
+weather_cache = TTLCache(maxsize=512, name="weather")
+# the last forecast per grid cell, served while Open-Meteo is unreachable. A forecast
+# covers 7 days, so one fetched on an earlier day still has today's hours
+last_forecasts = TTLCache(maxsize=512, ttl=6 * 24 * 3600, name="weather_fallback")
+
+HourlyForecast = namedtuple("HourlyForecast", ["times", "temps", "codes", "index"])
+
+def seconds_until_next_forecast_refresh():
+    now = datetime.now()
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return max((next_hour - now).total_seconds(), 60)
+
+@traced("weather_api")
+def fetch_hourly_forecast(lat, lon):
+    data = providers.hourly_forecast(lat, lon)
+    logger.debug("Weather API called for (lat: %s, lon: %s)", lat, lon)
+    return hourly_forecast_from_response(data)
+
+def hourly_forecast_from_response(data):
+    times = data['hourly']['time']
+    # index maps "YYYY-MM-DDTHH:00" to its position so hour lookups don't scan the list
+    return HourlyForecast(times, data['hourly']['temperature_2m'], data['hourly']['weathercode'],
+                          {t: i for i, t in enumerate(times)})
+
+def get_weather_forecast(site):
+    lat, lon = get_coordinates(site)
+    if lat is None:
+        raise ValueError(f"No coordinates found for {site}")
+    key = weather_key(lat, lon)
+    try:
+        forecast = weather_cache.get_or_compute(key, lambda: fetch_hourly_forecast(key[0], key[1]),
+                                                ttl=lambda _: seconds_until_next_forecast_refresh())
+    except UpstreamError as e:
+        forecast = last_forecasts.get(key[:2])
+        if forecast is None:
+            raise
+        logger.warning("Weather service unavailable (%s), using the forecast fetched for %s", e, forecast.times[0][:10])
+        return forecast
+    last_forecasts.set(key[:2], forecast)
+    return forecast
+
+def weather_key(lat, lon):
+    """weather_cache key, (grid lat, grid lon, local date)"""
+    return round(lat, WEATHER_GRID_DECIMALS), round(lon, WEATHER_GRID_DECIMALS), datetime.today().date().isoformat()
+
+@traced("weather")
 def choose_weather(site, time, flag=False):
     # idea of the flag variable: to suggest another time with better temperature 
     # based on getting weather forcasting for times after the specified one
     # (check all hours > time until not hot) and before closing_time for that site
     date = datetime.today().date()
-    print(f"date = {date}")
+    logger.debug("date = %s", date)
     visit_datetime = datetime.combine(date, time)
-    print(f"visit_datetime = {visit_datetime}")
+    logger.debug("visit_datetime = %s", visit_datetime)
     target_time = visit_datetime.strftime("%Y-%m-%dT%H:00")
-    print(f"target_time = {target_time}")
-    times, temps, codes = get_todays_weather(site)
+    logger.debug("target_time = %s", target_time)
+    times, temps, codes, index = get_weather_forecast(site)
     if flag:
-        print(f"[DEBUG] choose_weather entered with flag = {flag}")
+        logger.debug("choose_weather entered with flag = %s", flag)
         closing_time = datetime.combine(date, datetime.strptime("18:00", "%H:%M").time())
-        print(f"closing_time = {closing_time}")
-        print(f"times.index(target_time)+1 = {times.index(target_time)+1}")
-        print(f"len(times) = {len(times)}")
-        for perfect_time_index in range(times.index(target_time)+1,len(times)):
+        logger.debug("closing_time = %s", closing_time)
+        logger.debug("index[target_time]+1 = %s", index[target_time]+1)
+        logger.debug("len(times) = %s", len(times))
+        for perfect_time_index in range(index[target_time]+1,len(times)):
             forecast_time = datetime.fromisoformat(times[perfect_time_index])
-            print(f'forecast_time = {forecast_time}')
+            logger.debug('forecast_time = %s', forecast_time)
             if forecast_time < closing_time and (temps[perfect_time_index] < 35 or codes[perfect_time_index] not in [61, 63, 65, 95]):
                 return {
                 "time": forecast_time,
@@ -277,8 +542,8 @@ def choose_weather(site, time, flag=False):
             else:
                 return None # ask user to avoid going that day
 
-    elif target_time in times:
-            idx = times.index(target_time)
+    elif target_time in index:
+            idx = index[target_time]
             return {
                 "temperature": temps[idx],
                 "weather_code": codes[idx]
@@ -289,7 +554,7 @@ def choose_weather(site, time, flag=False):
 def analyze_weather(weather):
     temp = weather["temperature"]
     code = weather["weather_code"]
-    print(f"[DEBUG] Analyzing weather: temp = {temp}, code = {code}")
+    logger.debug("Analyzing weather: temp = %s, code = %s", temp, code)
 
     if temp > 35:
         return "very hot.", True
@@ -301,75 +566,110 @@ def analyze_weather(weather):
         return "good for a visit.", False
 
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    print(f"[DEBUG] Calculating distance between ({lat1},{lon1}) and ({lat2},{lon2})")
-    R = 6371  # Radius of Earth in km
-    dlat = radians(lat2 - lat1)
-    dlon = radians(lon2 - lon1)
-    a = sin(dlat/2)**2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c  # in km
-
-
+@traced("directions_api")
 def get_route_polyline_points(origin, destination):
-    url = "https://maps.googleapis.com/maps/api/directions/json"
-    params = {
-        "origin": origin,
-        "destination": destination,
-        "key": GOOGLE_MAPS_API
-    }
-    response = requests.get(url, params=params).json()
-    print(f"[DEBUG] Fetching route from {origin} to {destination}")
-    if response["status"] != "OK":
-        print(f"[ERROR] Directions API failed: {response}")
-        return []
-    
-    points = []
-    for step in response["routes"][0]["legs"][0]["steps"]:
-        loc = step["end_location"]
-        points.append((loc["lat"], loc["lng"]))
-    return points
+    """Route from origin to destination as an (n, 2) array of lat/lon, None when Google has no route"""
+    response = providers.directions(origin, destination)
+    logger.debug("Fetching route from %s to %s", origin, destination)
+    return route_points_from_response(response)
 
+def route_points_from_response(response):
+    if response["status"] != "OK":
+        logger.error("Directions API failed: %s", response)
+        return None
+
+    # the overview polyline follows the road, the step end points alone cut across corners
+    points = decode_polyline(response["routes"][0]["overview_polyline"]["points"])
+    return points if len(points) else None
+
+
+ON_THE_WAY_KM = 5  # a site within this distance of the route counts as on the way
+
+# the catalog arrays are rebuilt only when the list of sites or the spatial index changes
+site_catalog = {"key": None, "catalog": None}
+site_catalog_lock = threading.Lock()
+
+def get_site_catalog(lesser_known_sites):
+    key = (site_index.version, tuple(lesser_known_sites))
+    with site_catalog_lock:
+        if site_catalog["key"] == key:
+            return site_catalog["catalog"]
+    entries = [site_index.get(name) for name in lesser_known_sites]
+    entries = [entry for entry in entries if entry is not None]
+    catalog = SiteCatalog([e['site_name'] for e in entries], [(e['latitude'], e['longitude']) for e in entries])
+    with site_catalog_lock:
+        site_catalog["key"], site_catalog["catalog"] = key, catalog
+    return catalog
+
+route_cache = RouteCache(db)
+
+@traced("route_rank")
+def route_corridor(route_points, lesser_known_sites, site):
+    """Sites on the way as [(name, km)], or just the nearest one when none is close enough"""
+    catalog = get_site_catalog(lesser_known_sites)
+    ranked = catalog.rank_along_route(np.asarray(route_points, dtype=np.float64), exclude=[site])
+    logger.debug("Closest lesser-known sites to the route: %s", ranked[:5])
+    on_the_way = [[name, dist] for name, dist in ranked if dist < ON_THE_WAY_KM]
+    return on_the_way or [list(pair) for pair in ranked[:1]]
+
+def get_route_corridor(user_location, lesser_known_sites, site):
+    """Corridor of the route to site, served from the route cache when possible.
+
+    A cached route costs no Directions call, and its corridor is reused as long
+    as less_known_sites has not changed since it was computed.
+    """
+    points, corridor = route_cache.get(user_location, site)
+    if corridor is not None:
+        return corridor
+    # read the version first, a site changing while we rank makes the stored corridor stale
+    version = route_cache.sites_version()
+    sync_site_index(version)
+    if points is None:
+        points = get_route_polyline_points(user_location, site)
+        if points is None:
+            return None
+        corridor = route_corridor(points, lesser_known_sites, site)
+        route_cache.put(user_location, site, points, corridor, version)
+    else:
+        corridor = route_corridor(points, lesser_known_sites, site)
+        route_cache.set_corridor(user_location, site, corridor, version)
+    return corridor
 
+@traced("route")
 def filter_sites_on_the_way(user_location, lesser_known_sites, site):
-    print(f"[DEBUG] User location: {user_location}")
-    print(f"[DEBUG] Main site: {site}")
-    print(f"[DEBUG] Available lesser known sites: {lesser_known_sites}")
+    logger.debug("User location: %s", user_location)
+    logger.debug("Main site: %s", site)
+    logger.debug("Available lesser known sites: %s", lesser_known_sites)
     origin_coords = get_coordinates(user_location)
     dest_coords = get_coordinates(site)
-    if not origin_coords or not dest_coords:
-        print(f"[DEBUG] Origin coords: {origin_coords}, Dest coords: {dest_coords}, place is not found on google maps")
+    if origin_coords[0] is None or dest_coords[0] is None:
+        logger.debug("Origin coords: %s, Dest coords: %s, place is not found on google maps", origin_coords, dest_coords)
         return None #the place is not found on google maps
 
-    route_points = get_route_polyline_points(user_location, site)
-    if not route_points:
-        print(f"[DEBUG] Route points: {route_points}")
+    try:
+        corridor = get_route_corridor(user_location, lesser_known_sites, site)
+    except UpstreamError as e:
+        # no Directions answer, rank along the straight line between the two places instead (not cached)
+        logger.warning("Directions unavailable (%s), using a straight line from %s to %s", e, user_location, site)
+        sync_site_index()
+        corridor = route_corridor([origin_coords, dest_coords], lesser_known_sites, site)
+    if corridor is None:
+        logger.debug("No route found")
         return None #i dont know what could be the problem 
         #If it's None, the issue is inside get_route_polyline_points() — you may want to log the response or error from the API there.
-    
-    on_the_way = []
-    distance= {}
-    for lesser_site in lesser_known_sites:
-        site_coords = get_coordinates(lesser_site)
-        if not site_coords: continue
-        for route_lat, route_lon in route_points:
-            dist = haversine_distance(site_coords[0], site_coords[1], route_lat, route_lon)
-            distance[lesser_site] = dist
-            if dist < 5:  # within 5km of the route
-                on_the_way.append(lesser_site)
-                break
-
-    print(f"[DEBUG] Distance map: {distance}, On-the-way sites: {on_the_way}")
-    print(f"[DEBUG] Lesser-known site '{lesser_site}' distance = {dist} km")
+    if not corridor:
+        return None
+
+    on_the_way = [name for name, dist in corridor if dist < ON_THE_WAY_KM]
     if on_the_way:
         return random.choice(on_the_way)
     else:
         # return the site with the least distination
-        return min(distance, key=distance.get)
+        return corridor[0][0]
 
 
 def query_site_info(site):
-    print(f"[DEBUG] Querying info for site: {site}")    
+    logger.debug("Querying info for site: %s", site)
     site_data = get_site_by_name(site)
     if site_data:
         return (site_data['description'], site_data['category'])
@@ -377,19 +677,29 @@ def query_site_info(site):
         return ("a place of interest", "General")
 
 
+WEATHER_UNAVAILABLE = "\nThe weather forecast for {site} is unavailable right now, so do not comment on the weather."
+DEGRADED_ANSWER_TTL = 60  # seconds an answer given without weather is kept, the service may be back by then
+
+def answer_ttl(prompt):
+    """How long answer_cache keeps the answer to prompt"""
+    if WEATHER_UNAVAILABLE.partition("{site}")[2] in prompt:
+        return DEGRADED_ANSWER_TTL
+    return seconds_until_next_forecast_refresh()
+
+@traced("prompt_build")
 def build_prompt(site, time, crowd_level, weather, suggested_site):
-    print('build_prompt emtered')
-    print(f'site = {site}')
-    print(f'time = {time}')
-    print(f'crowd = {crowd_level}')
-    print(f'weather = {weather}')
-    print(f'suggested_site = {suggested_site}')
+    logger.debug('build_prompt emtered')
+    logger.debug('site = %s', site)
+    logger.debug('time = %s', time)
+    logger.debug('crowd = %s', crowd_level)
+    logger.debug('weather = %s', weather)
+    logger.debug('suggested_site = %s', suggested_site)
     
     if isinstance(time, str):
         try:
             time = datetime.fromisoformat(time)
         except ValueError:
-            print("[WARN] Time string not ISO format, skipping formatting.")
+            logger.warning("Time string not ISO format, skipping formatting.")
             pass
 
     if isinstance(time, datetime):
@@ -402,17 +712,15 @@ def build_prompt(site, time, crowd_level, weather, suggested_site):
         71: "Light snow", 95: "Thunderstorm"
     }
 
-    prompt = """You are a helpful tourism assistant for visitors to Jordan, You previously said:
-    "Hello! I'm your Jordan travel assistant.Please enter the place you plan to visit,
-    your intended time, and your current location. I'll help you find the best time to go and
-    suggest other interesting stops along the way."
-    Now, the user has provided all the required information.
-    Do not talk too much, be professional.
-    Thank them for sharing these details, and proceed to offer personalized advice based on their input.\n
-    """
+    prompt = prompts.render("advice")
    
-    text, flag = analyze_weather(weather)
-    prompt += f"\nAt {time}, the temperature at {site} is expected to be {weather['temperature']}°C, which is considered {text.lower()}."
+    if weather is None:
+        # the weather service is down and there is no earlier forecast, advise on the rest
+        prompt += WEATHER_UNAVAILABLE.format(site=site)
+        flag = False
+    else:
+        text, flag = analyze_weather(weather)
+        prompt += f"\nAt {time}, the temperature at {site} is expected to be {weather['temperature']}°C, which is considered {text.lower()}."
 
     if flag: #weather is not good
         suggested_weather = choose_weather(site,time,flag)
@@ -426,43 +734,45 @@ def build_prompt(site, time, crowd_level, weather, suggested_site):
                 f"when weather conditions are expected to be more suitable. "
                 f"The weather at that time is described as: {weather_desc}."
             )
-            crowd_level = predict_crowd(site,suggested_weather['time'])
+            # guarded like the other lookups, a failed forecast leaves the crowd out of the advice
+            crowd_level = run_lookups({"crowd": (predict_crowd, (site, suggested_weather['time']))})["crowd"] \
+                or "Unknown"
             if crowd_level == "High":
                 prompt += (
                     f" However, please note that {site} is expected to be very crowded at that time. "
                     "If you prefer a less crowded experience, you may wish to postpone your visit."
                 )
     else: #weather is good
-        print("[DEBUG] Weather is suitable for visit")
-        weather_desc = weather_descriptions.get(weather["weather_code"], "unavailable")
-        prompt += f"\nThe weather is generally suitable for visiting. Conditions are described as: {weather_desc}."
+        if weather is not None:
+            logger.debug("Weather is suitable for visit")
+            weather_desc = weather_descriptions.get(weather["weather_code"], "unavailable")
+            prompt += f"\nThe weather is generally suitable for visiting. Conditions are described as: {weather_desc}."
 
-        print(f"[DEBUG] Initial crowd level = {crowd_level}")
+        logger.debug("Initial crowd level = %s", crowd_level)
         if crowd_level.lower() == 'high':
-            print(f"[DEBUG] High crowd detected at {site} at {time}")
+            logger.debug("High crowd detected at %s at %s", site, time)
             prompt += f"\nHowever, {site} is expected to be very crowded at {time}."
 
             perfect_time = datetime.combine(datetime.today(), time)
-            closing_time = datetime.strptime("18:00", "%H:%M")
-            closing_datetime = datetime.combine(datetime.today(), closing_time.time())
+            closing_datetime = datetime.combine(datetime.today(), datetime.min.time()).replace(hour=CLOSING_HOUR)
 
+            # one batched forecast for the whole day instead of a model call per hour
+            day_forecast = predict_crowd_day(site, perfect_time.date())
             found_better_time = False
             while perfect_time <= closing_datetime:
-                candidate_time = perfect_time.time()
-                print(f"[DEBUG] Checking alternative time: {candidate_time}")
-                alt_crowd = predict_crowd(site, candidate_time)
-                print(f"[DEBUG] Predicted crowd at {candidate_time} = {alt_crowd}")
-                if alt_crowd.lower() in ["moderate", "low"]:
+                alt_crowd = day_forecast[perfect_time.hour]["level"]
+                logger.debug("Predicted crowd at %s = %s", perfect_time.time(), alt_crowd)
+                if alt_crowd and alt_crowd.lower() in ["moderate", "low"]:
                     found_better_time = True
                     break
                 perfect_time += timedelta(hours=1)
             if found_better_time:
                 prompt += f"\nTo avoid large crowds, I suggest visiting {site} at {perfect_time.time()} instead."
             else:
-                print("[DEBUG] No less crowded time found before closing.")
+                logger.debug("No less crowded time found before closing.")
                 prompt += f"\nUnfortunately, it seems there is no less crowded time slot before closing hours."
         else:
-            print("[DEBUG] Crowd level is not high, no alternative suggestion needed.")
+            logger.debug("Crowd level is not high, no alternative suggestion needed.")
 
 
     if suggested_site:
@@ -472,94 +782,211 @@ def build_prompt(site, time, crowd_level, weather, suggested_site):
             f"a nearby destination known for {desc.lower()}. It is categorized under '{category.lower()}' "
             "and could enrich your journey."
         )
-        prompt += "\n notes: 1.write times as AM/PM format not as given, and dont mention the date at all. 2.let this sentence be at the end of your answer: Have a wonderful time exploring Jordan. You are most welcome!"
+        prompt += prompts.render("advice_notes")
 
     return prompt.strip()
 
 
 
+@traced("off_topic")
 def is_off_topic(user_input):
-    print(f"[DEBUG] Checking if off-topic: {user_input}")
-    prompt = f"""You are a strict tourism assistant focused on planning visits to places in Jordan.
-    Decide if the following user message contains concrete information about at least one of:
-    - the user's current location,
-    - their planned time of visit,
-    - or their desired destination in Jordan.
-
-    If the message does NOT contain any of these, answer "Yes" (it is off-topic).
-    If the message DOES contain at least one of these, answer "No" (it is on-topic).
-
-    User message: "{user_input}"
-    
-    Answer with "Yes" or "No" only.
-    """
-    result = run_model(prompt).strip()
-    print(f"[DEBUG] LLM response: {result}")
+    logger.debug("Checking if off-topic: %s", user_input)
+    prompt = prompts.render("off_topic", user_input=user_input)
+    result = run_model(prompt, priority=CLASSIFY).strip()
+    logger.debug("LLM response: %s", result)
     return result.lower() == "yes"
     
 
 
+def causal_talk_prompt(user_input):
+    logger.debug("Casual talk mode for input: %s", user_input)
+    return prompts.render("casual_talk", user_input=user_input)
+
+
+@traced("casual_talk")
 def causal_talk(user_input):
-    print(f"[DEBUG] Casual talk mode for input: {user_input}")
-    prompt = f"""
-    You are a helpful tourism assistant for visitors to Jordan, You previously said:
-    "Hello! I'm your Jordan travel assistant.Please enter the place you plan to visit,
-    your intended time, and your current location. I'll help you find the best time to go and
-    suggest other interesting stops along the way.
-    The user said: "{user_input}"
-    Looks like the user is not providing any information and is talking to you about something else,
-    Respond in a friendly, casual way. You are a chatbot assisting tourists in Jordan, so keep the reply short and light.
-    and remind them to provide the information needed to find the best time to go and suggest other interesting stops along the way.
-
-    note: you are not allowed to offer suggesting any of these 
-    """
-    response = run_model(prompt)
+    response = run_model(causal_talk_prompt(user_input))
     return response.strip()
 
 
-def generate_chatbot_response(user_input):
-    print("[DEBUG] generate_chatbot_response entered")
+# Independent upstream lookups (crowd, weather, route) of a chat request run on this
+# shared pool, so a request waits for its slowest lookup instead of the sum of all of them
+LOOKUP_WORKERS = 16
+LOOKUP_TIMEOUTS = {"crowd": 5, "weather": 10, "route": 20}  # seconds
+lookup_pool = ThreadPoolExecutor(max_workers=LOOKUP_WORKERS, thread_name_prefix="lookup")
+
+def run_lookups(calls, timeouts=LOOKUP_TIMEOUTS):
+    """Run independent lookups at the same time.
+
+    calls maps a name to (function, args). Returns {name: result}, a lookup that
+    raised or did not finish within its timeout gets None so the caller can
+    carry on with whatever did come back.
+    """
+    started = time_module.monotonic()
+    # each lookup runs in a copy of the caller's context so its spans keep the request's trace
+    futures = {name: lookup_pool.submit(contextvars.copy_context().run, func, *args)
+               for name, (func, args) in calls.items()}
+    results = {}
+    # collect in deadline order, each lookup only gets what is left of its own timeout
+    for name, future in sorted(futures.items(), key=lambda item: timeouts.get(item[0], 10)):
+        remaining = timeouts.get(name, 10) - (time_module.monotonic() - started)
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except Exception as e:
+            future.cancel()
+            logger.warning("Lookup '%s' failed: %r", name, e)
+            results[name] = None
+    return results
+
+MISSING_DETAILS_REPLY = "Please enter the place you plan to visit, your intended time, and your current location in one message."
+SLOT_DESCRIPTIONS = {"current_location": "your current location", "visit_time": "the time you plan to visit",
+                     "destination": "the place you plan to visit"}
+
+def missing_details_reply(info, session):
+    """Ask for what is missing, in a session only for the details not given yet"""
+    given = [slot for slot in SLOTS if info.get(slot)]
+    if session is None or not given:
+        return MISSING_DETAILS_REPLY
+    missing = [SLOT_DESCRIPTIONS[slot] for slot in SLOTS if not info.get(slot)]
+    return f"Thanks! To plan your visit I still need {' and '.join(missing)}."
+
+@traced("prepare")
+def prepare_chatbot_prompt(user_input, info=None, session=None):
+    """Everything before the final generation, returns (prompt, None) or (None, direct reply).
+
+    With a chat session, lookups it already made with the same arguments are not made again.
+    """
+    logger.debug("prepare_chatbot_prompt entered")
     sites_data = get_all_sites()
     lesser_known_sites = [site['site_name'] for site in sites_data] 
 
-    #extract target site and time from user_input
-    user_location = extract_info_using_llm('current location',user_input)
-    print(f"[DEBUG] Extracted user_location: {user_location}")
-    time_raw = extract_info_using_llm('visit time',user_input)
-    if time_raw is None:
-        return """Please enter the place you plan to visit, your intended time, and your current location in one message. """
-    time = parser.parse(time_raw).time()
-    print(f"[DEBUG] Extracted visit time: {time_raw} → {time}")
-    site = extract_info_using_llm('destination',user_input)
-    print(f"[DEBUG] Extracted destination site: {site}")
+    #extract target site and time from user_input, chat() already did it in the same call as the off-topic check
+    if info is None:
+        info = cached_extract_trip_info(user_input)
+    user_location = info['current_location']
+    logger.debug("Extracted user_location: %s", user_location)
+    time_raw = info['visit_time']
+    time = parse_visit_time(time_raw) if time_raw is not None else None
+    if time is None:
+        # an unreadable time is asked for again like a missing one
+        return None, missing_details_reply(dict(info, visit_time=None), session)
+    logger.debug("Extracted visit time: %s → %s", time_raw, time)
+    site = info['destination']
+    logger.debug("Extracted destination site: %s", site)
     if not site or not user_location:
-        return """Please enter the place you plan to visit, your intended time, and your current location in one message."""
+        return None, missing_details_reply(info, session)
+
+    #crowd prediction, weather (weatherAPI) and sites on the way (google maps) don't depend
+    #on each other, so they are fetched at the same time
+    calls = {
+        "crowd": (predict_crowd, (site, time)),
+        "weather": (choose_weather, (site, time)),
+        "route": (filter_sites_on_the_way, (user_location, lesser_known_sites, site)),
+    }
+    lookup_keys = {"crowd": (normalize_message(site), time), "weather": (normalize_message(site), time),
+                   "route": (normalize_message(user_location), normalize_message(site))}
+    known = {}
+    if session is not None:
+        for name, (func, args) in list(calls.items()):
+            found, result = session.lookup(name, lookup_keys[name])
+            if found:
+                known[name] = result
+                del calls[name]
+            else:
+                calls[name] = (session.remembering(name, lookup_keys[name], func), args)
+    lookups = run_lookups(calls)
+    lookups.update(known)
 
-    #predict crowd level at the site
-    crowd_level = predict_crowd(site,time)
-    print(f"[DEBUG] Predicted crowd level: {crowd_level}")
+    crowd_level = lookups["crowd"] or "Unknown"
+    logger.debug("Predicted crowd level: %s", crowd_level)
 
-    #fetch weather from weatherAPI
-    weather = choose_weather(site,time)
-    print(f"[DEBUG] Weather info: {weather}")
+    weather = lookups["weather"]
+    logger.debug("Weather info: %s", weather)
     if weather is None:
-        return f"I couldn't fetch the weather for {site}. Please check the site name."
+        hit, coords = geocode_store.get(site.lower().strip())
+        if not (hit and coords):
+            return None, f"I couldn't fetch the weather for {site}. Please check the site name."
+        logger.warning("No weather for %s, answering without it", site)
 
-    #use google maps to check which are on the way
-    suggested_site = filter_sites_on_the_way(user_location, lesser_known_sites, site)
-    print(f"[DEBUG] Suggested site: {suggested_site}")
+    suggested_site = lookups["route"]
+    logger.debug("Suggested site: %s", suggested_site)
 
     #build prompt dynamically based on all data
     prompt = build_prompt(site, time, crowd_level, weather, suggested_site)
-    print(f"[DEBUG] Final prompt: \n{prompt}")
+    logger.debug("Final prompt: \n%s", prompt)
+    return prompt, None
+
+
+# Two cache levels for whole chats, both expire with the hourly weather forecast:
+# normalized message -> extracted trip info, and itinerary -> (prompt, final answer)
+extraction_cache = TTLCache(maxsize=2048, name="extraction")
+answer_cache = TTLCache(maxsize=1024, name="answer")
+# trip details and lookups of each conversation, keyed by the session id chatbot.js sends
+chat_sessions = SessionStore()
+
+def normalize_message(text):
+    """Lowercase, drop punctuation and extra spaces so near-identical messages share a key"""
+    return " ".join(re.sub(r"[^\w\s:]", " ", text.lower()).split())
+
+def cached_extract_trip_info(user_input):
+    return extraction_cache.get_or_compute(normalize_message(user_input),
+                                           lambda: extract_trip_info(user_input),
+                                           ttl=lambda _: seconds_until_next_forecast_refresh())
+
+def itinerary_key(info):
+    """(location, destination, visit time, date) of a complete request, None if a slot is missing"""
+    if not (info.get('current_location') and info.get('destination') and info.get('visit_time')):
+        return None
+    try:
+        visit_time = parser.parse(info['visit_time']).strftime("%H:%M")
+    except (ValueError, OverflowError):
+        return None
+    return (normalize_message(info['current_location']), normalize_message(info['destination']),
+            visit_time, datetime.today().date().isoformat())
+
+def trip_info(user_input, session=None):
+    """Extracted trip details of a message, completed from the earlier messages of its session"""
+    info = cached_extract_trip_info(user_input)
+    return session.merge(info) if session is not None else info
+
+def generate_chatbot_response(user_input, info=None, session=None):
+    logger.debug("generate_chatbot_response entered")
+    if info is None:
+        info = trip_info(user_input, session)
+    key = itinerary_key(info)
+    cached = answer_cache.get(key) if key else None
+    if cached is not None:
+        logger.debug("Answer cache hit for %s", key)
+        return cached[1]
+
+    prompt, reply = prepare_chatbot_prompt(user_input, info, session)
+    if reply is not None:
+        return reply
 
     #send to local llm
-    response = run_model(prompt)
-    print(f"[DEBUG] Final response from LLM: {response}")
+    with span("generate"):
+        response = run_model(prompt)
+    logger.debug("Final response from LLM: %s", response)
+    if key:
+        answer_cache.set(key, (prompt, response), ttl=answer_ttl(prompt))
     
     return response
 
 
+@app.before_request
+def begin_request_trace():
+    g.trace_id = start_trace()
+    g.request_started = time_module.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        request_duration.observe(time_module.perf_counter() - started, request.method,
+                                 request.url_rule.rule if request.url_rule else 'unmatched', str(response.status_code))
+    response.headers['X-Trace-Id'] = g.get('trace_id', '')
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -576,34 +1003,199 @@ def audio_guide():
 def help():
     return render_template('help.html')
 
+# answer of /chat and /chat/stream when the LLM queue is full (503)
+BUSY_REPLY = "I'm helping a lot of travellers right now, please try again in a moment."
+BUSY_RETRY_AFTER = '5'
+
+def chat_message(data):
+    """The lowercased message of a /chat or /chat/stream body, raises ValueError when it isn't one (400)"""
+    if not isinstance(data, dict) or not isinstance(data.get('message'), str):
+        raise ValueError('request body must be a JSON object with a string message')
+    return data['message'].lower()
+
 @app.route('/chat', methods=['POST'])
 def chat():
+    data = request.get_json(silent=True)
     try:
-        data = request.get_json()
-        user_message = data.get('message', '').lower()
-        print(f"[DEBUG] Received user message: {user_message}")
+        user_message = chat_message(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    try:
+        logger.debug("Received user message: %s", user_message)
+        session = chat_sessions.get(data.get('session_id'))
 
-        isofftopic = is_off_topic(user_message)
-        print(f"[DEBUG] Off-topic check result: {isofftopic}")
-        if isofftopic: response = causal_talk(user_message)
+        info = trip_info(user_message, session)
+        logger.debug("Off-topic check result: %s", not info['on_topic'])
+        if not info['on_topic']: response = causal_talk(user_message)
 
         else:
-            response = generate_chatbot_response(user_message)
+            response = generate_chatbot_response(user_message, info, session)
 
         return jsonify({
             'response': response,
             'status': 'success'
         })
     
+    except LLMBusy as e:
+        logger.warning("Chat refused, LLM queue full: %s", e)
+        return jsonify({'response': BUSY_REPLY, 'status': 'error'}), 503, {'Retry-After': BUSY_RETRY_AFTER}
     except Exception as e:
-        print(f"[ERROR] {e}")
+        logger.error("Chat request failed: %s", e)
         return jsonify({
             'response': 'Sorry, I encountered an error. Please try again.',
             'status': 'error'
         }), 500
 
+@app.route('/api/crowd/<site>', methods=['GET'])
+def get_crowd_forecast(site):
+    """Hourly crowd forecast for a site on a given day (?date=YYYY-MM-DD, defaults to today)"""
+    try:
+        date_param = request.args.get('date')
+        try:
+            date = datetime.strptime(date_param, "%Y-%m-%d").date() if date_param else datetime.today().date()
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'date must be in YYYY-MM-DD format'}), 400
+
+        forecast = predict_crowd_day(site, date)
+        if all(f["count"] is None for f in forecast):
+            return jsonify({'status': 'error', 'message': f'No crowd data available for {date}'}), 404
+
+        return jsonify({
+            'site': site,
+            'date': date.isoformat(),
+            'hourly': forecast,
+            'best_slot': best_crowd_slot(forecast),
+            'status': 'success'
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/api/crowd/heatmap', methods=['GET'])
+def get_crowd_heatmap():
+    """Hourly crowd forecast of a site over a range of days (?site=&from=YYYY-MM-DD&to=YYYY-MM-DD).
+
+    Columnar: count[i * 24 + h] and level[i * 24 + h] are hour h of dates[i].
+    from defaults to today, to to the end of the precomputed horizon.
+    """
+    site = request.args.get('site', '').strip()
+    if not site:
+        return jsonify({'status': 'error', 'message': 'site is required'}), 400
+    try:
+        first = datetime.strptime(request.args['from'], "%Y-%m-%d").date() if request.args.get('from') \
+            else datetime.today().date()
+        last = datetime.strptime(request.args['to'], "%Y-%m-%d").date() if request.args.get('to') \
+            else datetime.today().date() + timedelta(days=HORIZON_DAYS - 1)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'from and to must be in YYYY-MM-DD format'}), 400
+    if last < first or (last - first).days >= MAX_HEATMAP_DAYS:
+        return jsonify({'status': 'error',
+                        'message': f'to must be on or after from, and at most {MAX_HEATMAP_DAYS} days apart'}), 400
+    try:
+        heatmap = crowd_heatmap.read(site, first, last)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+    return jsonify(dict(heatmap, site=site, status='success'))
+
+def sse_event(data, event=None):
+    """Format one Server-Sent Events message"""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Same as /chat, but the answer is sent as Server-Sent Events while it is generated"""
+    data = request.get_json(silent=True)
+    try:
+        user_message = chat_message(data)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    logger.debug("Received user message (stream): %s", user_message)
+    if providers.scheduler.busy():
+        return jsonify({'response': BUSY_REPLY, 'status': 'error'}), 503, {'Retry-After': BUSY_RETRY_AFTER}
+    session = chat_sessions.get(data.get('session_id'))
+
+    def generate():
+        # an early comment line flushes the headers so the browser knows the request is alive
+        yield ": processing\n\n"
+        try:
+            info = trip_info(user_message, session)
+            key = itinerary_key(info) if info['on_topic'] else None
+            cached = answer_cache.get(key) if key else None
+            if cached is not None:
+                prompt, reply = None, cached[1]
+            elif not info['on_topic']:
+                prompt, reply = causal_talk_prompt(user_message), None
+            else:
+                prompt, reply = prepare_chatbot_prompt(user_message, info, session)
+
+            if reply is not None:
+                yield sse_event({'token': reply})
+            else:
+                tokens = []
+                with span("generate"):
+                    for token in stream_model(prompt):
+                        tokens.append(token)
+                        yield sse_event({'token': token})
+                if key:
+                    answer_cache.set(key, (prompt, "".join(tokens)), ttl=answer_ttl(prompt))
+            yield sse_event({'status': 'success'}, event='done')
+        except LLMBusy as e:
+            logger.warning("Streamed chat refused, LLM queue full: %s", e)
+            yield sse_event({'status': 'error', 'response': BUSY_REPLY}, event='error')
+        except Exception as e:
+            logger.error("Streamed chat request failed: %s", e)
+            yield sse_event({'status': 'error', 'response': 'Sorry, I encountered an error. Please try again.'}, event='error')
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # stop nginx from buffering the stream
+    })
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Hit/miss counters of the in-process caches"""
+    return jsonify({
+        'caches': [cache.stats() for cache in (extraction_cache, answer_cache, weather_cache, last_forecasts, route_cache,
+                                               chat_sessions)],
+        'status': 'success'
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Stage and request latency histograms, cache counters, upstream circuit states and the LLM queue,
+    in the Prometheus text format"""
+    caches = (extraction_cache, answer_cache, weather_cache, last_forecasts, route_cache, chat_sessions)
+    return Response(render_metrics(cache_metrics([cache.stats() for cache in caches]) + breaker_metrics()
+                                   + providers.scheduler.metric_lines()),
+                    mimetype='text/plain; version=0.0.4')
+
 #_________________________________________________________________
 # Database management routes
+@app.route('/api/sensors/bulk', methods=['POST'])
+def bulk_sensor_upload():
+    """Upsert many sensor readings from an NDJSON or CSV request body"""
+    try:
+        content_type = (request.mimetype or '').lower()
+        if content_type in ('application/x-ndjson', 'application/jsonl', 'application/json-lines'):
+            reader = read_ndjson
+        elif content_type in ('text/csv', 'application/csv'):
+            reader = read_csv
+        else:
+            return jsonify({
+                'status': 'error',
+                'message': 'Send the rows as application/x-ndjson or text/csv'
+            }), 415
+
+        # read the body as a stream so large uploads are never held in memory at once
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        stats = ingest_sensor_data(reader(lines))
+        return jsonify(dict(stats, status='success'))
+    except UnicodeDecodeError:
+        # chunks before the bad bytes are already written, sending the file again is harmless
+        return jsonify({'status': 'error', 'message': 'The request body is not valid UTF-8'}), 400
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/api/sites', methods=['GET'])
 def get_sites():
     """Get all sites from database"""
@@ -616,6 +1208,33 @@ def get_sites():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/api/sites/near', methods=['GET'])
+def get_sites_near():
+    """Sites around a point (?lat=&lon=&radius_km=&k=), closest first"""
+    try:
+        try:
+            lat = float(request.args['lat'])
+            lon = float(request.args['lon'])
+            radius_km = request.args.get('radius_km', type=float)
+            k = request.args.get('k', type=int)
+        except (KeyError, ValueError):
+            return jsonify({'status': 'error', 'message': 'lat and lon are required numbers'}), 400
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return jsonify({'status': 'error', 'message': 'lat/lon out of range'}), 400
+        if (radius_km is not None and radius_km <= 0) or (k is not None and k <= 0):
+            return jsonify({'status': 'error', 'message': 'radius_km and k must be positive'}), 400
+        if radius_km is None and k is None:
+            radius_km = 10
+
+        sync_site_index()
+        results = site_index.query(lat, lon, radius_km=radius_km, k=k)
+        return jsonify({
+            'sites': [dict(site, distance_km=round(dist, 3)) for dist, site in results],
+            'status': 'success'
+        })
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/api/sites', methods=['POST'])
 def add_new_site():
     """Add a new site to database"""
@@ -631,7 +1250,11 @@ def add_new_site():
                 'message': 'All fields (site_name, category, description) are required'
             }), 400
         
-        success, message = add_site(site_name, category, description)
+        try:
+            latitude, longitude = parse_coordinates(data.get('latitude'), data.get('longitude'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        success, message = add_site(site_name, category, description, latitude, longitude)
         
         if success:
             return jsonify({'status': 'success', 'message': message})
@@ -656,7 +1279,11 @@ def update_existing_site(site_id):
                 'message': 'All fields (site_name, category, description) are required'
             }), 400
         
-        success = update_site(site_id, site_name, category, description)
+        try:
+            latitude, longitude = parse_coordinates(data.get('latitude'), data.get('longitude'))
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        success = update_site(site_id, site_name, category, description, latitude, longitude)
         
         if success:
             return jsonify({'status': 'success', 'message': 'Site updated successfully'})
@@ -681,6 +1308,54 @@ def delete_existing_site(site_id):
         return jsonify({'status': 'error', 'message': str(e)}), 500
 #____________________________________________________________________________________________
 
+# Importing this module only defines things: no database work, no model loading, no
+# threads, and pandas, scikit-learn, requests and ollama are imported on first use.
+# Whatever serves the app calls create_app() once (gunicorn 'app:create_app()',
+# uvicorn asgi:application, or python app.py), scripts like fill_db.py call only
+# the helpers they need.
+
+def configure_logging():
+    # ASFAR_LOG_LEVEL=DEBUG brings back the step by step output, the default only logs INFO and above
+    logging.basicConfig(level=os.getenv("ASFAR_LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+
+def warm_up():
+    """Load what the first chat would otherwise wait for: crowd models, the site geocodes and the LLM"""
+    started = time_module.perf_counter()
+    crowd_engine.ensure_loaded()
+    warm_geocode_store()
+    if not providers.offline:
+        try:
+            # loads llama3 and evaluates the shared system prompt, the first chat starts from the cached prefix
+            providers.warm_prefix(prompts.SYSTEM_PROMPT)
+        except Exception as e:
+            logger.warning("LLM warm-up failed: %s", e)
+    logger.info("Warm-up finished in %.2fs", time_module.perf_counter() - started)
+
+app_ready = threading.Event()
+app_init_lock = threading.Lock()
+
+def create_app(warm=True):
+    """Bring the database up to date and load the site index, returns the Flask app.
+
+    With warm=True the crowd models and geocodes are loaded on a background
+    thread, so the worker accepts requests right away, and the crowd heatmap
+    refresh job is started. Calling it again is a no-op.
+    """
+    with app_init_lock:
+        if app_ready.is_set():
+            return app
+        configure_logging()
+        init_database()
+        sync_site_index()
+        geocode_store.import_json("location_cache.json")
+        if warm:
+            threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+            crowd_heatmap.start()
+        app_ready.set()
+    return app
+
 if __name__ == '__main__':
-    print("[INFO] Flask app is starting at http://0.0.0.0:5000")
+    create_app()
+    logger.info("Flask app is starting at http://0.0.0.0:5000")
     app.run(debug=True, host='0.0.0.0', port=5000) 
@@ -0,0 +1,294 @@
+"""ASGI entry point: /chat and /chat/stream on the event loop, every other route served by the Flask app.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+The chat handlers await the LLM, Google Maps and Open-Meteo through the async
+provider calls (httpx.AsyncClient and ollama.AsyncClient), so a chat waiting on
+upstream services holds a coroutine instead of a thread. Upstream answers go
+into the same caches the Flask code reads (geocode store, weather cache, route
+cache), then app.prepare_chatbot_prompt runs on a worker thread for the
+milliseconds it takes when every lookup is a cache hit. Answers are the same as
+the sync routes give, and both paths share the extraction and answer caches.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from asgiref.wsgi import WsgiToAsgi
+
+import app as asfar
+from llm_scheduler import LLMBusy
+from telemetry import request_duration, span, start_trace
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1024 * 1024
+
+ERROR_REPLY = 'Sorry, I encountered an error. Please try again.'
+
+
+async def run_model(prompt, role="user", format=None, priority=None):
+    with span("llm"):
+        response = await asfar.providers.achat(asfar.model_messages(prompt, role), format=format,
+                                               priority=priority)
+    return response['message']['content']
+
+
+async def extract_trip_info(user_input):
+    """Async app.cached_extract_trip_info"""
+    key = asfar.normalize_message(user_input)
+    info = asfar.extraction_cache.get(key)
+    if info is not None:
+        return info
+    with span("extract"):
+        prompt = asfar.trip_extraction_prompt(user_input)
+        retry_prompt = prompt
+        for attempt in range(asfar.EXTRACTION_RETRIES + 1):
+            info, error = asfar.parse_trip_info(await run_model(retry_prompt, format='json'))
+            if info is not None:
+                break
+            logger.warning("Bad extractor output (attempt %s): %s", attempt + 1, error)
+            retry_prompt = asfar.extraction_retry_prompt(prompt, error)
+        else:
+            logger.warning("Falling back to per-field extraction")
+            info = await asyncio.to_thread(asfar.extract_trip_info_per_field, user_input)
+    asfar.extraction_cache.set(key, info, ttl=asfar.seconds_until_next_forecast_refresh())
+    return info
+
+
+async def get_coordinates(site):
+    site = site.lower().strip()
+    hit, coords = asfar.geocode_store.get(site)
+    if hit:
+        return coords if coords else (None, None)
+    with span("geocode"):
+        response = await asfar.providers.ageocode(site)
+    return asfar.remember_geocode(site, response)
+
+
+_weather_fetches = {}  # weather_cache key -> task, so concurrent chats about one place share a fetch
+
+async def prefetch_weather(site):
+    lat, lon = await get_coordinates(site)
+    if lat is None:
+        return
+    key = asfar.weather_key(lat, lon)
+    if asfar.weather_cache.get(key) is not None:
+        return
+    task = _weather_fetches.get(key)
+    if task is None:
+        task = _weather_fetches[key] = asyncio.ensure_future(fetch_weather(key))
+        task.add_done_callback(lambda _: _weather_fetches.pop(key, None))
+    # shield it, one chat going away must not cancel the fetch the others wait on
+    await asyncio.shield(task)
+
+
+async def fetch_weather(key):
+    with span("weather_api"):
+        data = await asfar.providers.ahourly_forecast(key[0], key[1])
+    asfar.weather_cache.set(key, asfar.hourly_forecast_from_response(data),
+                            ttl=asfar.seconds_until_next_forecast_refresh())
+
+
+async def prefetch_route(origin, destination):
+    points, _ = asfar.route_cache.get(origin, destination)
+    if points is not None:
+        return
+    with span("directions_api"):
+        response = await asfar.providers.adirections(origin, destination)
+    points = asfar.route_points_from_response(response)
+    if points is not None:
+        # the corridor is ranked by filter_sites_on_the_way on the worker thread
+        asfar.route_cache.put(origin, destination, points)
+
+
+async def prepare_chatbot_prompt(user_input, info, session=None):
+    """Fetch what the chat needs concurrently, then build the prompt from the warm caches"""
+    location, site = info.get('current_location'), info.get('destination')
+    if location and site and info.get('visit_time'):
+        with span("prefetch"):
+            results = await asyncio.gather(get_coordinates(location), prefetch_weather(site),
+                                           prefetch_route(location, site), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                # the sync pipeline retries it and degrades the answer the way it always has
+                logger.warning("Prefetch failed: %r", result)
+    return await asyncio.to_thread(asfar.prepare_chatbot_prompt, user_input, info, session)
+
+
+async def trip_info(user_message, session):
+    """Async app.trip_info"""
+    info = await extract_trip_info(user_message)
+    return session.merge(info) if session is not None else info
+
+
+async def chat_response(user_message, session=None):
+    """Async app.chat, returns the reply text"""
+    info = await trip_info(user_message, session)
+    if not info['on_topic']:
+        with span("casual_talk"):
+            return (await run_model(asfar.causal_talk_prompt(user_message))).strip()
+
+    key = asfar.itinerary_key(info)
+    cached = asfar.answer_cache.get(key) if key else None
+    if cached is not None:
+        return cached[1]
+    prompt, reply = await prepare_chatbot_prompt(user_message, info, session)
+    if reply is not None:
+        return reply
+    with span("generate"):
+        response = await run_model(prompt)
+    if key:
+        asfar.answer_cache.set(key, (prompt, response), ttl=asfar.answer_ttl(prompt))
+    return response
+
+
+async def read_json(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > MAX_BODY_BYTES:
+            raise ValueError("request body too large")
+        if not message.get("more_body"):
+            break
+    data = json.loads(body or b"{}")
+    if not isinstance(data, dict):
+        raise ValueError("request body must be a JSON object")
+    return data
+
+
+async def bad_request(send, trace_id, error):
+    await send(response_start(400, b"application/json", trace_id))
+    await send({"type": "http.response.body", "body": json.dumps({'status': 'error', 'message': str(error)}).encode()})
+    return 400
+
+
+def busy_headers(status):
+    return [(b"retry-after", asfar.BUSY_RETRY_AFTER.encode())] if status == 503 else []
+
+
+def response_start(status, content_type, trace_id, extra_headers=()):
+    headers = [(b"content-type", content_type), (b"x-trace-id", trace_id.encode())] + list(extra_headers)
+    return {"type": "http.response.start", "status": status, "headers": headers}
+
+
+async def chat(receive, send, trace_id):
+    try:
+        data = await read_json(receive)
+        user_message = asfar.chat_message(data)
+    except ValueError as e:
+        return await bad_request(send, trace_id, e)
+    try:
+        logger.debug("Received user message: %s", user_message)
+        session = asfar.chat_sessions.get(data.get('session_id'))
+        payload, status = {'response': await chat_response(user_message, session), 'status': 'success'}, 200
+    except LLMBusy as e:
+        logger.warning("Chat refused, LLM queue full: %s", e)
+        payload, status = {'response': asfar.BUSY_REPLY, 'status': 'error'}, 503
+    except Exception as e:
+        logger.error("Chat request failed: %s", e)
+        payload, status = {'response': ERROR_REPLY, 'status': 'error'}, 500
+    await send(response_start(status, b"application/json", trace_id, busy_headers(status)))
+    await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+    return status
+
+
+async def chat_stream(receive, send, trace_id):
+    """Async app.chat_stream, the answer goes out as Server-Sent Events while it is generated"""
+    try:
+        data = await read_json(receive)
+        user_message = asfar.chat_message(data)
+    except ValueError as e:
+        return await bad_request(send, trace_id, e)
+    logger.debug("Received user message (stream): %s", user_message)
+    if asfar.providers.scheduler.busy():
+        await send(response_start(503, b"application/json", trace_id, busy_headers(503)))
+        await send({"type": "http.response.body",
+                    "body": json.dumps({'response': asfar.BUSY_REPLY, 'status': 'error'}).encode()})
+        return 503
+    session = asfar.chat_sessions.get(data.get('session_id'))
+
+    async def emit(text):
+        await send({"type": "http.response.body", "body": text.encode(), "more_body": True})
+
+    await send(response_start(200, b"text/event-stream", trace_id, [
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]))
+    await emit(": processing\n\n")
+    try:
+        info = await trip_info(user_message, session)
+        key = asfar.itinerary_key(info) if info['on_topic'] else None
+        cached = asfar.answer_cache.get(key) if key else None
+        if cached is not None:
+            prompt, reply = None, cached[1]
+        elif not info['on_topic']:
+            prompt, reply = asfar.causal_talk_prompt(user_message), None
+        else:
+            prompt, reply = await prepare_chatbot_prompt(user_message, info, session)
+
+        if reply is not None:
+            await emit(asfar.sse_event({'token': reply}))
+        else:
+            tokens = []
+            with span("generate"):
+                stream = await asfar.providers.achat_stream(asfar.model_messages(prompt))
+                async for chunk in stream:
+                    token = chunk['message']['content']
+                    if token:
+                        tokens.append(token)
+                        await emit(asfar.sse_event({'token': token}))
+            if key:
+                asfar.answer_cache.set(key, (prompt, "".join(tokens)), ttl=asfar.answer_ttl(prompt))
+        await emit(asfar.sse_event({'status': 'success'}, event='done'))
+    except LLMBusy as e:
+        logger.warning("Streamed chat refused, LLM queue full: %s", e)
+        await emit(asfar.sse_event({'status': 'error', 'response': asfar.BUSY_REPLY}, event='error'))
+    except Exception as e:
+        logger.error("Streamed chat request failed: %s", e)
+        await emit(asfar.sse_event({'status': 'error', 'response': ERROR_REPLY}, event='error'))
+    await send({"type": "http.response.body", "body": b""})
+    return 200
+
+
+ASYNC_ROUTES = {
+    ("POST", "/chat"): chat,
+    ("POST", "/chat/stream"): chat_stream,
+}
+
+
+class AsfarASGI:
+    """Routes the chat endpoints to the async handlers and everything else to Flask"""
+
+    def __init__(self, flask_app):
+        self.flask = WsgiToAsgi(flask_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        handler = ASYNC_ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+        if handler is None:
+            return await self.flask(scope, receive, send)
+
+        trace_id = start_trace()
+        started = time.perf_counter()
+        status = 500
+        try:
+            status = await handler(receive, send, trace_id)
+        finally:
+            request_duration.observe(time.perf_counter() - started, scope["method"], scope["path"], str(status))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asfar.providers.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+application = AsfarASGI(asfar.create_app())
@@ -0,0 +1,112 @@
+"""Import time budget of the app and the scripts built on it.
+
+Each target runs in a fresh interpreter, in a scratch directory with stubbed
+services, a few times; the median is compared to its budget. The run fails
+(exit code 1) when a target is over budget or when importing it pulls in one
+of the heavy modules that must only load on first use.
+
+    python benchmarks/import_budget.py
+    python benchmarks/import_budget.py --runs 10 --top 15
+
+Targets:
+
+    app         import app, what every worker and script pays first
+    fill_db     import fill_db
+    create_app  import app and create_app(warm=False), a worker's cold start
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {
+    "app": "import app",
+    "fill_db": "import fill_db",
+    "create_app": "import app; app.create_app(warm=False)",
+}
+BUDGET_MS = {"app": 750, "fill_db": 750, "create_app": 900}
+# loaded on first use only, importing the app must not pull these in
+LAZY_MODULES = ("pandas", "sklearn", "scipy", "joblib", "requests", "ollama", "httpx")
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+print(json.dumps({{"seconds": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def child_env():
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, ASFAR_PROVIDERS="stub", ASFAR_LOG_LEVEL="WARNING")
+    env.pop("PYTHONPROFILEIMPORTTIME", None)
+    return env
+
+
+def run_target(code, workdir, importtime=False):
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD.format(code=code)]
+    result = subprocess.run(command, cwd=workdir, env=child_env(), capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, top):
+    """(cumulative µs, module) of the slowest modules the target imports directly, from -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # the target is nested one level (two spaces) below the top, its own imports one more
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if cumulative.strip().isdigit() and depth == 1:
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Check the import time of the app against a budget")
+    arg_parser.add_argument("--targets", nargs="+", choices=TARGETS, default=list(TARGETS))
+    arg_parser.add_argument("--runs", type=int, default=5, help="timed runs per target, the median counts")
+    arg_parser.add_argument("--scale", type=float, default=1.0,
+                            help="multiply every budget, for slow machines")
+    arg_parser.add_argument("--top", type=int, default=0, help="also list the N slowest modules each target imports")
+    args = arg_parser.parse_args()
+
+    failures = []
+    print(f"{'target':<12}{'median ms':>12}{'budget ms':>12}")
+    for target in args.targets:
+        workdir = tempfile.mkdtemp(prefix="asfar-import-")
+        run_target(TARGETS[target], workdir)  # untimed, writes the .pyc files
+        timings, modules = [], []
+        for _ in range(args.runs):
+            report, _ = run_target(TARGETS[target], workdir)
+            timings.append(report["seconds"] * 1000)
+            modules = report["modules"]
+        median = statistics.median(timings)
+        budget = BUDGET_MS[target] * args.scale
+        print(f"{target:<12}{median:>12.1f}{budget:>12.0f}")
+        if median > budget:
+            failures.append(f"{target}: {median:.1f}ms, budget {budget:.0f}ms")
+        loaded = [name for name in LAZY_MODULES if name in modules]
+        if loaded:
+            failures.append(f"{target}: imports {', '.join(loaded)} eagerly")
+        if args.top:
+            _, stderr = run_target(TARGETS[target], workdir, importtime=True)
+            for cumulative, name in slowest_imports(stderr, args.top):
+                print(f"    {cumulative / 1000:>9.1f} ms  {name}")
+
+    if failures:
+        print(f"{len(failures)} over budget:")
+        for line in failures:
+            print(f"  {line}")
+        sys.exit(1)
+    print("Within budget")
+
+
+if __name__ == "__main__":
+    main()
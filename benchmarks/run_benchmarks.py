@@ -0,0 +1,292 @@
+"""End-to-end benchmarks of the chat pipeline and the crowd engine.
+
+Runs the app against stubbed external services (see providers.py) in a
+throwaway working directory, so nothing touches Google, Open-Meteo, Ollama or
+the real tourism_database.db. Every scenario is run for each catalog size and
+concurrency level, and reports p50/p95/p99 latency and throughput.
+
+    python benchmarks/run_benchmarks.py                      # full matrix
+    python benchmarks/run_benchmarks.py --quick              # small matrix for a quick check
+    python benchmarks/run_benchmarks.py --output new.json --baseline baseline.json
+
+With --baseline the run fails (exit code 1) when a scenario's p95 grows or its
+throughput drops by more than --tolerance compared to the same scenario,
+catalog size and concurrency in the baseline file. Set ASFAR_PROVIDERS=replay
+to benchmark against recorded fixtures instead of stubs, and
+ASFAR_REPLAY_LATENCY to add upstream latency (by default stubs answer
+instantly so only our own overhead is measured).
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from datetime import time as clock_time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# files the app opens relative to its working directory
+DATA_FILES = ("linear_regression_petramodel.pkl", "scaler.pkl", "petra_counts_to_august.csv")
+
+SCENARIOS = ("chat", "chat_uncached", "api_sites", "predict_crowd", "filter_sites_on_the_way",
+             "route_corridor", "build_prompt")
+CATALOG_SIZES = (20, 1000, 10000, 100000)
+CONCURRENCY = (1, 8, 32)
+QUICK = {"sizes": (20, 1000), "concurrency": (1, 8), "requests": 40}
+
+DESTINATION = "Petra"
+ORIGINS = [f"Benchmark Origin {i}" for i in range(64)]
+
+
+def load_app():
+    """Import app inside a scratch directory with stubbed services"""
+    mode = os.environ.setdefault("ASFAR_PROVIDERS", "stub")
+    if mode not in ("stub", "replay"):
+        sys.exit(f"benchmarks run against stub or replay providers, not '{mode}'")
+    os.environ.setdefault("ASFAR_LOG_LEVEL", "WARNING")
+    workdir = tempfile.mkdtemp(prefix="asfar-bench-")
+    for name in DATA_FILES:
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(workdir, name))
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    with quiet():
+        import app
+        app.create_app(warm=False)
+    return app, workdir
+
+
+@contextlib.contextmanager
+def quiet():
+    """Send anything the app prints to /dev/null, it would drown the report"""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def seed_crowd_model(app, days=21):
+    """Hourly readings for DESTINATION up to now and a model trained on them, so predict_crowd has history"""
+    from crowd_models import load_sensor_series
+
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    rng = random.Random(0)
+    records = []
+    for i in range(days * 24):
+        hour = now - timedelta(hours=days * 24 - 1 - i)
+        shape = max(0.0, math.sin(math.pi * (hour.hour - 6) / 12)) if 6 <= hour.hour <= 18 else 0.0
+        count = int(100 * shape + rng.randint(0, 8))
+        records.append((i + 1, {"date": hour.date().isoformat(), "hour": hour.hour,
+                                "site_name": DESTINATION, "count": count}))
+    app.ingest_sensor_data(records)
+    app.crowd_registry.train_all(load_sensor_series(app.db), workers=1)
+    app.crowd_engine.seed_buffers()
+
+
+def fill_catalog(app, size):
+    """Replace the lesser-known sites with `size` generated sites spread over Jordan"""
+    rng = random.Random(size)
+    rows = [(f"Benchmark Site {i:06d}", "Benchmark", "Generated for benchmarks.",
+             rng.uniform(29.5, 32.5), rng.uniform(35.0, 38.0)) for i in range(size)]
+    app.clear_sites_table()
+    with app.db.connection() as conn, conn:
+        conn.executemany('INSERT INTO less_known_sites (site_name, category, description, latitude, longitude) '
+                         'VALUES (?, ?, ?, ?, ?)', rows)
+    app.load_site_index()
+    return [row[0] for row in rows]
+
+
+def make_scenarios(app, site_names):
+    client = app.app.test_client()
+    counter = iter(range(10 ** 9))
+    counter_lock = threading.Lock()
+    route_points = app.get_route_polyline_points(ORIGINS[0], DESTINATION)
+    weather = {"temperature": 24.0, "weather_code": 0}
+
+    def next_id():
+        with counter_lock:
+            return next(counter)
+
+    def chat():
+        i = next_id()
+        response = client.post("/chat", json={"message": f"I'm in {ORIGINS[i % len(ORIGINS)]}, "
+                                                          f"visiting {DESTINATION} at 10am ({i})"})
+        if response.status_code != 200:
+            raise RuntimeError(f"/chat returned {response.status_code}")
+
+    def api_sites():
+        response = client.get("/api/sites")
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/sites returned {response.status_code}")
+
+    def predict_crowd():
+        app.predict_crowd(DESTINATION, clock_time(next_id() % 12 + 6))
+
+    def filter_sites_on_the_way():
+        app.filter_sites_on_the_way(ORIGINS[next_id() % len(ORIGINS)], site_names, DESTINATION)
+
+    def route_corridor():
+        app.route_corridor(route_points, site_names, DESTINATION)
+
+    def build_prompt():
+        app.build_prompt(DESTINATION, clock_time(10), "High", weather, site_names[0])
+
+    return {
+        "chat": chat,
+        "chat_uncached": chat,  # same calls, run with the response caches switched off
+        "api_sites": api_sites,
+        "predict_crowd": predict_crowd,
+        "filter_sites_on_the_way": filter_sites_on_the_way,
+        "route_corridor": route_corridor,
+        "build_prompt": build_prompt,
+    }
+
+
+@contextlib.contextmanager
+def response_caches_disabled(app):
+    caches = (app.extraction_cache, app.answer_cache)
+    sizes = [cache.maxsize for cache in caches]
+    for cache in caches:
+        cache.invalidate()
+        cache.maxsize = 0
+    try:
+        yield
+    finally:
+        for cache, size in zip(caches, sizes):
+            cache.maxsize = size
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    rank = q / 100 * (len(sorted_values) - 1)
+    low, high = math.floor(rank), math.ceil(rank)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+def measure(call, requests, concurrency, warmup):
+    for _ in range(warmup):
+        call()
+    latencies, errors = [], []
+
+    def timed(_):
+        started = time.perf_counter()
+        try:
+            call()
+        except Exception as e:
+            errors.append(repr(e))
+            return None
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for elapsed in pool.map(timed, range(requests)):
+            if elapsed is not None:
+                latencies.append(elapsed)
+    wall = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "requests": requests,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of results against a baseline report, as printable lines"""
+    reference = {(r["scenario"], r["sites"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["scenario"], result["sites"], result["concurrency"])
+        old = reference.get(key)
+        if old is None:
+            continue
+        name = f"{key[0]} sites={key[1]} concurrency={key[2]}"
+        if old["p95_ms"] and result["p95_ms"] and result["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {old['p95_ms']}ms -> {result['p95_ms']}ms")
+        if old["throughput_rps"] and result["throughput_rps"] is not None \
+                and result["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result["errors"] > old["errors"]:
+            regressions.append(f"{name}: {result['errors']} errors (baseline {old['errors']})")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the chat pipeline against stubbed services")
+    arg_parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    arg_parser.add_argument("--sizes", nargs="+", type=int, help=f"catalog sizes (default {CATALOG_SIZES})")
+    arg_parser.add_argument("--concurrency", nargs="+", type=int, help=f"threads (default {CONCURRENCY})")
+    arg_parser.add_argument("--requests", type=int, help="calls per scenario and level (default 200)")
+    arg_parser.add_argument("--warmup", type=int, default=5, help="untimed calls before each measurement")
+    arg_parser.add_argument("--quick", action="store_true", help="small matrix for a quick check")
+    arg_parser.add_argument("--output", default="benchmark_results.json")
+    arg_parser.add_argument("--baseline", help="earlier results to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="allowed relative slowdown before a result counts as a regression")
+    args = arg_parser.parse_args()
+    sizes = args.sizes or (QUICK["sizes"] if args.quick else CATALOG_SIZES)
+    concurrency = args.concurrency or (QUICK["concurrency"] if args.quick else CONCURRENCY)
+    requests = args.requests or (QUICK["requests"] if args.quick else 200)
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    app, workdir = load_app()
+    with quiet():
+        seed_crowd_model(app)
+
+    results = []
+    print(f"{'scenario':<26}{'sites':>8}{'threads':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'req/s':>10}{'errors':>8}")
+    for size in sizes:
+        with quiet():
+            site_names = fill_catalog(app, size)
+            scenarios = make_scenarios(app, site_names)
+        for name in args.scenarios:
+            for threads in concurrency:
+                caches = response_caches_disabled(app) if name == "chat_uncached" else contextlib.nullcontext()
+                with quiet(), caches:
+                    stats = measure(scenarios[name], requests, threads, args.warmup)
+                result = dict(scenario=name, sites=size, concurrency=threads, **stats)
+                results.append(result)
+                print(f"{name:<26}{size:>8}{threads:>8}{stats['p50_ms'] or '-':>10}{stats['p95_ms'] or '-':>10}"
+                      f"{stats['p99_ms'] or '-':>10}{stats['throughput_rps'] or '-':>10}{stats['errors']:>8}",
+                      flush=True)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "providers": os.environ["ASFAR_PROVIDERS"],
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output} (scratch directory {workdir})")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Conversation state of /chat and /chat/stream, kept per session id between messages.
+
+The chat page sends a session id with every message (chatbot.js keeps one per
+browser tab). A session remembers the trip details extracted so far and the
+lookups made for them, so a follow-up that only gives the missing detail
+("at 10 am") is answered from its own short extraction and the final
+generation: the user does not repeat the rest and the route is not searched
+again.
+
+Sessions live in memory, expire SESSION_TTL seconds after their last message,
+and at most MAX_SESSIONS are kept, the least recently used go first.
+"""
+import re
+import threading
+
+from caching import TTLCache
+
+SESSION_TTL = 30 * 60  # seconds
+MAX_SESSIONS = 5000
+SLOTS = ("current_location", "visit_time", "destination")
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+class ChatSession:
+    """Trip details and lookup results of one conversation"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.slots = dict.fromkeys(SLOTS)
+        self.lookups = {}  # lookup name -> (key of its arguments, result)
+        self._lock = threading.Lock()
+
+    def merge(self, info):
+        """info with the details it lacks filled in from earlier messages, its own ones remembered.
+
+        A message without trip details (small talk) is returned as it is and
+        leaves the session alone. info itself is not changed, it may be cached.
+        """
+        if not info.get("on_topic"):
+            return info
+        with self._lock:
+            for slot in SLOTS:
+                if info.get(slot):
+                    self.slots[slot] = info[slot]
+            return dict(info, **self.slots)
+
+    def lookup(self, name, key):
+        """(found, result) of lookup name made earlier with the same arguments"""
+        with self._lock:
+            entry = self.lookups.get(name)
+        if entry is None or entry[0] != key:
+            return False, None
+        return True, entry[1]
+
+    def remembering(self, name, key, func):
+        """func, with what it returns kept as the result of lookup name, a call that raises is not kept"""
+        def call(*args):
+            result = func(*args)
+            with self._lock:
+                self.lookups[name] = (key, result)
+            return result
+        return call
+
+
+class SessionStore:
+    """ChatSession by id, bounded in number and age"""
+
+    def __init__(self, maxsize=MAX_SESSIONS, ttl=SESSION_TTL):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl, name="sessions")
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """The session of session_id, created on first use, None for a missing or malformed id"""
+        if not isinstance(session_id, str) or not SESSION_ID.match(session_id):
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id)
+            self._sessions.set(session_id, session)  # every message starts the time to live over
+        return session
+
+    def stats(self):
+        return self._sessions.stats()
+
+    def __len__(self):
+        return len(self._sessions)
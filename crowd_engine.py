@@ -0,0 +1,326 @@
+import logging
+import os
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from crowd_models import CountScaler, site_key
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = "linear_regression_petramodel.pkl"
+SCALER_PATH = "scaler.pkl"
+COUNTS_PATH = "petra_counts_to_august.csv"
+
+N_HOURS = 24  # number of lag hours the model was trained on
+RELOAD_CHECK_INTERVAL = 5  # seconds between checks for changed files on disk
+BUFFER_HOURS = 24 * 14  # hours of live readings kept per site
+# how far past the last reading we forecast recursively, the lag models drift
+# after about a month of feeding on their own predictions
+MAX_FORECAST_HOURS = 24 * 31
+HOUR = timedelta(hours=1)
+
+
+def crowd_level(prediction):
+    """Map a predicted people count to a crowd level"""
+    if prediction >= 80:  # Peak hours
+        return "High"
+    elif prediction < 10:
+        return "Low"
+    else:
+        return "Moderate"
+
+
+def _to_hour(value):
+    """Truncate a datetime to the start of its hour"""
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _hour_index(start, visit_datetime):
+    return int((_to_hour(visit_datetime) - start).total_seconds() // 3600)
+
+
+def _as_hourly_array(series):
+    """(start datetime, counts array) where position i is the hour start + i hours"""
+    series = series.sort_index()
+    series = series[~series.index.duplicated(keep='last')].asfreq('h')
+    return series.index[0].to_pydatetime(), series.to_numpy(dtype=np.float64)
+
+
+class SiteCountBuffer:
+    """Ring buffer with the last `capacity` hourly counts of one site.
+
+    Slot (head + i) % capacity holds the hour end - capacity + i, missing hours
+    are NaN. Recording a reading is O(1) whatever the amount of history.
+    """
+
+    def __init__(self, capacity=BUFFER_HOURS):
+        self.capacity = capacity
+        self.values = np.full(capacity, np.nan)
+        self.head = 0
+        self.end = None  # the hour right after the newest slot
+        self.version = 0
+
+    def push(self, hour, count):
+        """Record the count of an hour, older than the buffer is ignored"""
+        hour = _to_hour(hour)
+        if self.end is None:
+            self.end = hour + HOUR
+            self.values[(self.head - 1) % self.capacity] = count
+            self.version += 1
+            return
+        ahead = _hour_index(self.end, hour)  # 0 means the hour right after the newest one
+        if ahead >= 0:
+            # move the window forward, hours skipped on the way become NaN
+            steps = ahead + 1
+            if steps >= self.capacity:
+                self.values[:] = np.nan
+                self.head = 0
+            else:
+                slots = (self.head + np.arange(steps)) % self.capacity
+                self.values[slots] = np.nan
+                self.head = (self.head + steps) % self.capacity
+            self.end = hour + HOUR
+            self.values[(self.head - 1) % self.capacity] = count
+        elif ahead >= -self.capacity:
+            self.values[(self.head + self.capacity + ahead) % self.capacity] = count
+        else:
+            return
+        self.version += 1
+
+    def snapshot(self):
+        """(start datetime, counts in time order)"""
+        ordered = np.roll(self.values, -self.head)
+        return self.end - self.capacity * HOUR, ordered
+
+
+def _one_step(model):
+    """Fast single-window prediction, a dot product for linear models"""
+    coef = getattr(model, "coef_", None)
+    if coef is not None:
+        coef = np.asarray(coef, dtype=np.float64).ravel()
+        intercept = float(np.ravel(model.intercept_)[0]) if np.ndim(model.intercept_) else float(model.intercept_)
+        return lambda window: float(window @ coef + intercept)
+    return lambda window: float(model.predict(window.reshape(1, -1))[0])
+
+
+def extend_series(model, scaled):
+    """Fill the gaps of a scaled series and forecast MAX_FORECAST_HOURS past its end.
+
+    Every missing hour whose previous N_HOURS are known (or were filled
+    already) gets the model's prediction, walking forward in time, so the
+    forecast of later hours feeds on the earlier ones.
+    """
+    step = _one_step(model)
+    extended = np.concatenate([scaled, np.full(MAX_FORECAST_HOURS, np.nan)])
+    missing = np.flatnonzero(np.isnan(extended))
+    for i in missing[missing >= N_HOURS]:
+        window = extended[i - N_HOURS:i]
+        if not np.isnan(window).any():
+            extended[i] = step(window)
+    return extended
+
+
+class CrowdForecastEngine:
+    """Holds the crowd models and the hourly count series in memory.
+
+    Each site's recent readings live in a SiteCountBuffer, seeded from
+    collected_data_from_sensors at startup and updated as new readings are
+    ingested. Series are kept as NumPy arrays where position i is the hour
+    `start + i hours`, extended with a recursive forecast, so the lag window
+    of any hour is plain arithmetic. The extension is recomputed only after
+    the buffer changes.
+
+    Sites with readings are predicted from them, with their own model from the
+    registry (see crowd_models) when there is one and the original Petra model
+    otherwise. Sites without readings fall back to petra_counts_to_august.csv.
+
+    Nothing is read from disk until the first prediction or an explicit
+    ensure_loaded(), so constructing the engine is free.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, scaler_path=SCALER_PATH, counts_path=COUNTS_PATH,
+                 registry=None, load_recent=None):
+        self.model_path = model_path
+        self.scaler_path = scaler_path
+        self.counts_path = counts_path
+        self.registry = registry
+        self.load_recent = load_recent  # load_recent(hours, sites) -> {site name: hourly pandas Series}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._mtimes = None
+        self._last_check = 0.0
+        self.model = None
+        self.scaler = None
+        self.legacy = None  # (start, extended scaled counts) of the Petra CSV
+        self.buffers = {}  # site key -> SiteCountBuffer
+        self._extended = {}  # site key -> (buffer version, model, start, extended scaled counts)
+
+    def _file_mtimes(self):
+        return tuple(os.path.getmtime(p) for p in (self.model_path, self.scaler_path, self.counts_path))
+
+    def reload(self):
+        """(Re)load the Petra model, its scaler, the count series and seed the site buffers"""
+        import joblib
+        import pandas as pd
+
+        mtimes = self._file_mtimes()
+        model = joblib.load(self.model_path)
+        scaler = CountScaler.from_sklearn(joblib.load(self.scaler_path))
+
+        df = pd.read_csv(self.counts_path, parse_dates=['datetime'])
+        start, counts = _as_hourly_array(df.set_index('datetime')['count'])
+        legacy = (start, extend_series(model, scaler.transform(counts)))
+
+        with self._lock:
+            self.model = model
+            self.scaler = scaler
+            self.legacy = legacy
+            self._mtimes = mtimes
+            self._last_check = _time.monotonic()
+        logger.info("Crowd engine loaded %s hourly counts starting %s", len(counts), start)
+        self.seed_buffers()
+
+    def seed_buffers(self, sites=None):
+        """Fill the site buffers with the latest readings of every site, or only of the given site names"""
+        if self.load_recent is None:
+            return
+        buffers = {}
+        for name, series in self.load_recent(BUFFER_HOURS, sites).items():
+            buffer = SiteCountBuffer()
+            for hour, count in series.dropna().items():
+                buffer.push(hour.to_pydatetime(), float(count))
+            buffers[site_key(name)] = buffer
+        with self._lock:
+            if sites is None:
+                self.buffers = buffers
+                self._extended.clear()
+            else:
+                self.buffers.update(buffers)
+                for key in buffers:
+                    self._extended.pop(key, None)
+        logger.log(logging.INFO if sites is None else logging.DEBUG, "Crowd engine seeded %s site buffers", len(buffers))
+
+    def models_version(self):
+        """Changes whenever the Petra model files or the registry manifest change on disk"""
+        self._maybe_reload()
+        return self._mtimes, self.registry.manifest_mtime() if self.registry is not None else None
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def observe(self, site, hour, count):
+        """Record a new reading of a site, O(1)"""
+        self.observe_many([(site, hour, count)])
+
+    def observe_many(self, readings):
+        """Record (site, hour, count) readings, grouped by site and pushed under one lock"""
+        keys = {}  # site name -> site key, a batch names the same few sites over and over
+        by_key = {}
+        for site, hour, count in readings:
+            key = keys.get(site)
+            if key is None:
+                key = keys[site] = site_key(site)
+            by_key.setdefault(key, []).append((hour, float(count)))
+        with self._lock:
+            for key, site_readings in by_key.items():
+                buffer = self.buffers.get(key)
+                if buffer is None:
+                    buffer = self.buffers[key] = SiteCountBuffer()
+                # readings a newer one of the batch pushes out of the buffer are skipped, the rest
+                # go in time order (stable, the last of two readings of an hour wins)
+                oldest = max(hour for hour, _ in site_readings) - (buffer.capacity - 1) * HOUR
+                for hour, count in sorted(site_readings, key=lambda reading: reading[0]):
+                    if hour >= oldest:
+                        buffer.push(hour, count)
+
+    def ensure_loaded(self):
+        """Load the model and series if nothing is loaded yet"""
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    self.reload()
+
+    def _maybe_reload(self):
+        self.ensure_loaded()
+        now = _time.monotonic()
+        if now - self._last_check < RELOAD_CHECK_INTERVAL:
+            return
+        self._last_check = now
+        if self.registry is not None and self.registry.reload_if_changed():
+            with self._lock:
+                self._extended.clear()
+        try:
+            changed = self._file_mtimes() != self._mtimes
+        except OSError:
+            return  # a file is being replaced, keep serving the loaded copy
+        if changed:
+            logger.info("Crowd model or count files changed on disk, reloading")
+            self.reload()
+
+    def _resolve(self, site):
+        """(model, scaler, start, extended scaled counts) used to forecast a site, call with the lock held"""
+        if site is not None:
+            key = site_key(site)
+            buffer = self.buffers.get(key)
+            if buffer is not None and buffer.end is not None:
+                artifact = self.registry.get(site)[0] if self.registry is not None else None
+                model, scaler = (artifact["model"], artifact["scaler"]) if artifact is not None \
+                    else (self.model, self.scaler)
+                cached = self._extended.get(key)
+                if cached is None or cached[0] != buffer.version or cached[1] is not model:
+                    start, counts = buffer.snapshot()
+                    cached = (buffer.version, model, start, extend_series(model, scaler.transform(counts)))
+                    self._extended[key] = cached
+                return model, scaler, cached[2], cached[3]
+        return (self.model, self.scaler) + self.legacy
+
+    def predict_count(self, visit_datetime, site=None):
+        """Predicted people count for the hour of visit_datetime, None without enough history before it"""
+        self._maybe_reload()
+        with self._lock:
+            model, scaler, start, series = self._resolve(site)
+        idx = _hour_index(start, visit_datetime)
+        if idx < N_HOURS or idx >= len(series):
+            logger.debug("No crowd history of %s for %s", site, visit_datetime)
+            return None
+        window = series[idx - N_HOURS:idx]
+        if np.isnan(window).any():
+            logger.debug("Incomplete crowd history of %s before %s", site, visit_datetime)
+            return None
+        return float(scaler.inverse(_one_step(model)(window)))
+
+    def predict_level(self, visit_datetime, site=None):
+        """Crowd level for the hour of visit_datetime, None when it can't be predicted"""
+        count = self.predict_count(visit_datetime, site)
+        return crowd_level(count) if count is not None else None
+
+    def predict_day_counts(self, day, site=None):
+        """Predicted people counts for the 24 hours of day, NaN where there is no history.
+
+        All 24 lag windows are taken as one strided view over the series and sent
+        to the model in a single predict call.
+        """
+        self._maybe_reload()
+        with self._lock:
+            model, scaler, start, series = self._resolve(site)
+        first = _hour_index(start, datetime.combine(day, datetime.min.time()))
+
+        # the windows of hours 0..23 cover series[first - 24 : first + 23],
+        # pad with NaN whatever falls outside the series
+        lo, hi = first - N_HOURS, first + 23
+        segment = np.full(hi - lo, np.nan)
+        src_lo, src_hi = max(lo, 0), min(hi, len(series))
+        if src_lo < src_hi:
+            segment[src_lo - lo:src_hi - lo] = series[src_lo:src_hi]
+
+        windows = sliding_window_view(segment, N_HOURS)  # shape (24, 24), no copy
+        valid = ~np.isnan(windows).any(axis=1)
+        result = np.full(24, np.nan)
+        if valid.any():
+            result[valid] = scaler.inverse(model.predict(windows[valid]))
+        return result
@@ -0,0 +1,189 @@
+"""Hourly crowd forecast per site and day, materialized in the crowd_forecast table.
+
+Answering "when is the quietest hour this week" from the live engine takes a
+forecast per day; from the table it is one indexed range read. A background
+thread keeps the table current:
+
+- sites with new sensor readings (marked in crowd_forecast_dirty by triggers,
+  whichever process wrote them) get their buffers reloaded and their days
+  recomputed every REFRESH_INTERVAL seconds, or right away after notify()
+- every tracked site is recomputed when the date changes or a model file
+  changes on disk, and days that have passed are dropped
+
+Tracked sites are the ones with sensor readings plus DEFAULT_SITES. Days of
+other sites are computed when first asked for, stored, and left to expire.
+"""
+import logging
+import math
+import threading
+import time
+from datetime import date as date_type
+from datetime import timedelta
+
+from crowd_engine import crowd_level
+from crowd_models import site_key
+
+logger = logging.getLogger(__name__)
+
+HORIZON_DAYS = 7  # today and the following days kept in the table
+REFRESH_INTERVAL = 60  # seconds between checks for new readings
+DEFAULT_SITES = ("petra",)  # forecast by the original model from petra_counts_to_august.csv
+
+UPSERT_SQL = '''
+    INSERT INTO crowd_forecast (site_key, date, hour, count, level, computed_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(site_key, date, hour) DO UPDATE SET
+        count = excluded.count, level = excluded.level, computed_at = excluded.computed_at
+'''
+
+
+def _day_rows(key, day, counts, now):
+    rows = []
+    for hour, count in enumerate(counts):
+        if math.isnan(count):
+            rows.append((key, day.isoformat(), hour, None, None, now))
+        else:
+            rows.append((key, day.isoformat(), hour, round(float(count), 1), crowd_level(count), now))
+    return rows
+
+
+class CrowdHeatmap:
+    """Reads and refreshes the crowd_forecast table of a CrowdForecastEngine"""
+
+    def __init__(self, db, engine, horizon_days=HORIZON_DAYS, interval=REFRESH_INTERVAL):
+        self.db = db
+        self.engine = engine
+        self.horizon_days = horizon_days
+        self.interval = interval
+        self._state = None  # (date, models version) of the last full refresh
+        self._refresh_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def horizon(self):
+        today = date_type.today()
+        return [today + timedelta(days=i) for i in range(self.horizon_days)]
+
+    def _compute(self, key, days):
+        now = time.time()
+        rows = []
+        for day in days:
+            rows += _day_rows(key, day, self.engine.predict_day_counts(day, key), now)
+        return rows
+
+    def _write(self, rows, delete_sql=None, delete_params=()):
+        with self.db.connection() as conn, conn:
+            if delete_sql:
+                conn.execute(delete_sql, delete_params)
+            conn.executemany(UPSERT_SQL, rows)
+
+    def tracked_sites(self):
+        with self.db.connection() as conn:
+            names = [row[0] for row in conn.execute('SELECT DISTINCT site_name FROM collected_data_from_sensors')]
+        return sorted({site_key(name) for name in names} | set(DEFAULT_SITES))
+
+    def refresh(self):
+        """Bring the table up to date, returns the number of sites recomputed"""
+        with self._refresh_lock:
+            days = self.horizon()
+            state = (days[0], self.engine.models_version())
+            if state != self._state:
+                refreshed = self._refresh_all(days)
+                self._state = state
+                return refreshed
+            return self._refresh_dirty(days)
+
+    def _refresh_all(self, days):
+        with self.db.connection() as conn, conn:
+            conn.execute('DELETE FROM crowd_forecast_dirty')
+        self.engine.seed_buffers()
+        sites = self.tracked_sites()
+        rows = []
+        for key in sites:
+            rows += self._compute(key, days)
+        # untracked sites were computed on demand, they go too and are recomputed when asked for again
+        placeholders = ",".join("?" * len(sites))
+        self._write(rows, f'DELETE FROM crowd_forecast WHERE date < ? OR site_key NOT IN ({placeholders})',
+                    (days[0].isoformat(), *sites))
+        logger.info("Crowd heatmap rebuilt for %s sites from %s", len(sites), days[0])
+        return len(sites)
+
+    def _refresh_dirty(self, days):
+        with self.db.connection() as conn:
+            dirty = conn.execute('SELECT site_name, changed_at FROM crowd_forecast_dirty').fetchall()
+        if not dirty:
+            return 0
+        names = [row['site_name'] for row in dirty]
+        # readings may have been written by another process, reload them before forecasting
+        self.engine.seed_buffers(names)
+        rows = []
+        for key in sorted({site_key(name) for name in names}):
+            rows += self._compute(key, days)
+        self._write(rows)
+        with self.db.connection() as conn, conn:
+            # a site written again while we were computing stays dirty for the next round
+            conn.executemany('DELETE FROM crowd_forecast_dirty WHERE site_name = ? AND changed_at <= ?',
+                             [(row['site_name'], row['changed_at']) for row in dirty])
+        logger.debug("Crowd heatmap refreshed %s sites with new readings", len(names))
+        return len(names)
+
+    def read(self, site, first, last):
+        """Forecast of site from first to last (dates, inclusive) as columns.
+
+        count[i * 24 + h] and level[i * 24 + h] are hour h of dates[i]. Days
+        missing from the table are computed, and stored when within the horizon.
+        """
+        key = site_key(site)
+        with self.db.connection() as conn:
+            rows = conn.execute(
+                'SELECT date, hour, count, level FROM crowd_forecast '
+                'WHERE site_key = ? AND date BETWEEN ? AND ? ORDER BY date, hour',
+                (key, first.isoformat(), last.isoformat())
+            ).fetchall()
+        by_day = {}
+        for row in rows:
+            by_day.setdefault(row['date'], []).append((row['count'], row['level']))
+
+        dates = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        missing = [day for day in dates if len(by_day.get(day.isoformat(), ())) != 24]
+        if missing:
+            computed = self._compute(key, missing)
+            horizon = {day.isoformat() for day in self.horizon()}
+            stored = [row for row in computed if row[1] in horizon]
+            if stored:
+                self._write(stored)
+            for day in missing:
+                by_day[day.isoformat()] = []
+            for row in computed:
+                by_day[row[1]].append((row[3], row[4]))
+
+        counts, levels = [], []
+        for day in dates:
+            for count, level in by_day[day.isoformat()]:
+                counts.append(count)
+                levels.append(level)
+        return {"dates": [day.isoformat() for day in dates], "hours": 24, "count": counts, "level": levels}
+
+    def day(self, site, day):
+        """One day as [{"hour", "count", "level"}], the shape app.predict_crowd_day returns"""
+        columns = self.read(site, day, day)
+        return [{"hour": hour, "count": count, "level": level}
+                for hour, (count, level) in enumerate(zip(columns["count"], columns["level"]))]
+
+    def notify(self):
+        """New readings were written, refresh without waiting for the interval"""
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="crowd-heatmap", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Crowd heatmap refresh failed: %s", e)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
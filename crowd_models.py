@@ -0,0 +1,292 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+logger = logging.getLogger(__name__)
+
+N_HOURS = 24  # lag hours, same as the original Petra model
+MODELS_DIR = "crowd_models"
+MANIFEST = "manifest.json"
+POOLED_KEY = "__pooled__"
+MIN_SITE_SAMPLES = 24 * 14  # a site needs two weeks of complete windows for its own model
+MIN_SCALER_HOURS = 24  # fewer readings than this and the site borrows the pooled scaler too
+KEEP_VERSIONS = 3
+
+
+def site_key(site):
+    return site.lower().strip()
+
+
+def site_slug(site):
+    """Directory name of a site's artifacts, readable and unique per site key ("wadi rum" and "wadi-rum" differ)"""
+    key = site_key(site)
+    readable = "".join(c if c.isalnum() else "_" for c in key).strip("_") or "site"
+    return f"{readable}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]}"
+
+
+class CountScaler:
+    """Standard scaling of people counts, kept as two floats so windows can be scaled without sklearn"""
+
+    def __init__(self, mean, scale):
+        self.mean = float(mean)
+        self.scale = float(scale) or 1.0
+
+    @classmethod
+    def fit(cls, values):
+        values = values[~np.isnan(values)]
+        return cls(values.mean(), values.std())
+
+    @classmethod
+    def from_sklearn(cls, scaler):
+        return cls(scaler.mean_[0], scaler.scale_[0])
+
+    def transform(self, values):
+        return (values - self.mean) / self.scale
+
+    def inverse(self, values):
+        return values * self.scale + self.mean
+
+
+def load_sensor_series(db, sites=None, limit_per_site=None):
+    """Hourly count series per site from collected_data_from_sensors, missing hours are NaN.
+
+    limit_per_site keeps only the newest readings of every site.
+    """
+    query = 'SELECT site_name, date, hour, count FROM collected_data_from_sensors'
+    params = ()
+    if sites:
+        query += f' WHERE site_name IN ({",".join("?" * len(sites))})'
+        params = tuple(sites)
+    if limit_per_site:
+        query = f'''
+            SELECT site_name, date, hour, count FROM (
+                SELECT site_name, date, hour, count,
+                       ROW_NUMBER() OVER (PARTITION BY site_name ORDER BY date DESC, hour DESC) AS newest
+                FROM ({query})
+            ) WHERE newest <= ?
+        '''
+        params += (limit_per_site,)
+    with db.connection() as conn:
+        rows = conn.execute(query, params).fetchall()
+    if not rows:
+        return {}
+    import pandas as pd
+
+    df = pd.DataFrame([tuple(row) for row in rows], columns=['site_name', 'date', 'hour', 'count'])
+    df['datetime'] = pd.to_datetime(df['date'] + ' ' + df['hour'], format='%Y-%m-%d %H:%M', errors='coerce')
+    df = df.dropna(subset=['datetime'])
+    series = {}
+    for name, group in df.groupby('site_name'):
+        s = group.set_index('datetime')['count'].astype(float).sort_index()
+        s = s[~s.index.duplicated(keep='last')].asfreq('h')
+        series[name] = s
+    return series
+
+
+def lag_windows(scaled):
+    """(X, y) training pairs of N_HOURS lags, skipping windows that touch a missing hour"""
+    if len(scaled) <= N_HOURS:
+        return np.empty((0, N_HOURS)), np.empty(0)
+    windows = sliding_window_view(scaled, N_HOURS + 1)
+    windows = windows[~np.isnan(windows).any(axis=1)]
+    return windows[:, :N_HOURS], windows[:, N_HOURS]
+
+
+def fit_lag_model(values, scaler=None):
+    """Train a linear lag model on one hourly series, runs inside the process pool"""
+    from sklearn.linear_model import LinearRegression
+
+    values = np.asarray(values, dtype=np.float64)
+    scaler = scaler or CountScaler.fit(values)
+    X, y = lag_windows(scaler.transform(values))
+    model = LinearRegression().fit(X, y)
+    mae = float(np.abs(scaler.inverse(model.predict(X)) - scaler.inverse(y)).mean())
+    return {"model": model, "scaler": scaler, "samples": len(X), "mae": mae}
+
+
+def _train_site(args):
+    name, values = args
+    return name, fit_lag_model(values)
+
+
+class CrowdModelRegistry:
+    """Versioned per-site crowd models on disk, with a pooled fallback model.
+
+    Layout: <models_dir>/<site slug>/v<timestamp>.pkl plus a manifest.json that
+    maps every site to its current artifact. The manifest is replaced
+    atomically, so readers never see a half-written registry. Artifacts are
+    loaded on first use.
+    """
+
+    def __init__(self, models_dir=MODELS_DIR):
+        self.models_dir = models_dir
+        self._lock = threading.Lock()
+        self._manifest = {}
+        self._models = {}  # manifest key -> loaded artifact
+        self._manifest_mtime = None
+        self._loaded = False
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.models_dir, MANIFEST)
+
+    def manifest_mtime(self):
+        try:
+            return os.path.getmtime(self.manifest_path)
+        except OSError:
+            return None
+
+    def reload(self):
+        """Read the manifest and load the artifacts it points to"""
+        import joblib
+
+        mtime = self.manifest_mtime()
+        manifest, models = {}, {}
+        if mtime is not None:
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+            for key, entry in manifest.items():
+                try:
+                    models[key] = joblib.load(os.path.join(self.models_dir, entry["path"]))
+                except Exception as e:
+                    logger.warning("Could not load crowd model for %s: %s", key, e)
+        with self._lock:
+            self._manifest, self._models, self._manifest_mtime = manifest, models, mtime
+            self._loaded = True
+        if models:
+            logger.info("Crowd model registry loaded %s models", len(models))
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.reload()
+
+    def reload_if_changed(self):
+        if not self._loaded or self.manifest_mtime() != self._manifest_mtime:
+            self.reload()
+            return True
+        return False
+
+    def get(self, site):
+        """(artifact, kind) for a site, kind is "site" or "pooled", or (None, None)"""
+        self._ensure_loaded()
+        with self._lock:
+            artifact = self._models.get(site_key(site))
+            if artifact is not None:
+                return artifact, "site"
+            pooled = self._models.get(POOLED_KEY)
+        if pooled is not None:
+            return pooled, "pooled"
+        return None, None
+
+    def sites(self):
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(key for key in self._manifest if key != POOLED_KEY)
+
+    def _save(self, key, artifact, version):
+        import joblib
+
+        directory = site_slug(key) if key != POOLED_KEY else "_pooled"
+        os.makedirs(os.path.join(self.models_dir, directory), exist_ok=True)
+        relative = os.path.join(directory, f"v{version}.pkl")
+        joblib.dump(artifact, os.path.join(self.models_dir, relative))
+        return relative
+
+    def _prune(self, manifest):
+        """Keep the last KEEP_VERSIONS artifacts of every site"""
+        for entry in manifest.values():
+            directory = os.path.join(self.models_dir, os.path.dirname(entry["path"]))
+            versions = sorted(f for f in os.listdir(directory) if f.endswith(".pkl"))
+            for old in versions[:-KEEP_VERSIONS]:
+                os.remove(os.path.join(directory, old))
+        known = {os.path.dirname(entry["path"]) for entry in manifest.values()}
+        for directory in os.listdir(self.models_dir):
+            path = os.path.join(self.models_dir, directory)
+            if os.path.isdir(path) and directory not in known:
+                shutil.rmtree(path)
+
+    def train_all(self, series_by_site, workers=None, min_samples=MIN_SITE_SAMPLES):
+        """Train every site with enough data in parallel and a pooled model from all of them.
+
+        series_by_site maps site names to hourly pandas Series (see
+        load_sensor_series). Returns the new manifest.
+        """
+        version = datetime.now().strftime("%Y%m%d%H%M%S")
+        arrays = {name: s.to_numpy(dtype=np.float64) for name, s in series_by_site.items()}
+        enough, small = {}, {}
+        for name, values in arrays.items():
+            samples = len(lag_windows(values)[0])
+            (enough if samples >= min_samples else small)[name] = values
+
+        trained = {}
+        if enough:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for name, artifact in pool.map(_train_site, enough.items()):
+                    trained[name] = artifact
+
+        # the pooled model learns the daily shape from every site's own scaled series,
+        # so busy and quiet sites contribute equally
+        pooled_X, pooled_y = [], []
+        for name, values in arrays.items():
+            X, y = lag_windows(CountScaler.fit(values).transform(values))
+            pooled_X.append(X)
+            pooled_y.append(y)
+        manifest = {}
+        if pooled_X and sum(len(y) for y in pooled_y):
+            from sklearn.linear_model import LinearRegression
+
+            X, y = np.concatenate(pooled_X), np.concatenate(pooled_y)
+            all_values = np.concatenate(list(arrays.values()))
+            pooled = {"model": LinearRegression().fit(X, y), "scaler": CountScaler.fit(all_values),
+                      "samples": len(X), "mae": None}
+            manifest[POOLED_KEY] = {"path": self._save(POOLED_KEY, pooled, version), "version": version,
+                                    "samples": len(X), "kind": "pooled"}
+
+            # small sites use the pooled model, but with their own scale when they have some history
+            for name, values in small.items():
+                if np.count_nonzero(~np.isnan(values)) < MIN_SCALER_HOURS:
+                    continue
+                artifact = dict(pooled, scaler=CountScaler.fit(values), samples=0)
+                manifest[site_key(name)] = {"path": self._save(name, artifact, version), "version": version,
+                                            "samples": 0, "kind": "pooled"}
+
+        for name, artifact in trained.items():
+            manifest[site_key(name)] = {"path": self._save(name, artifact, version), "version": version,
+                                        "samples": artifact["samples"], "mae": artifact["mae"], "kind": "site"}
+
+        os.makedirs(self.models_dir, exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+        self._prune(manifest)
+        self.reload()
+        return manifest
+
+
+if __name__ == "__main__":
+    # use the importable module, artifacts pickled from __main__ could not be loaded by the app
+    from crowd_models import CrowdModelRegistry, load_sensor_series
+    from database import Database
+
+    arg_parser = argparse.ArgumentParser(description="Train per-site crowd models from the sensor table")
+    arg_parser.add_argument("--db", default="tourism_database.db")
+    arg_parser.add_argument("--workers", type=int, default=None, help="training processes (default: CPU count)")
+    arg_parser.add_argument("--min-samples", type=int, default=MIN_SITE_SAMPLES,
+                            help="complete lag windows a site needs for its own model")
+    args = arg_parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
+
+    series = load_sensor_series(Database(args.db))
+    manifest = CrowdModelRegistry().train_all(series, workers=args.workers, min_samples=args.min_samples)
+    for key, entry in sorted(manifest.items()):
+        print(f"{key}: {entry['kind']} model v{entry['version']} ({entry['samples']} samples)")
@@ -0,0 +1,219 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Applied to every connection. WAL lets readers run while a writer commits,
+# synchronous=NORMAL is safe with WAL and avoids an fsync per transaction.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -20000",  # ~20MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",  # 256MB
+    "PRAGMA foreign_keys = ON",
+)
+
+
+def _create_base_tables(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS less_known_sites (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            site_name TEXT NOT NULL UNIQUE,
+            category TEXT NOT NULL,
+            description TEXT NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS collected_data_from_sensors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            site_name TEXT NOT NULL,
+            count INTEGER NOT NULL
+        )
+    ''')
+
+
+def _add_site_coordinates(conn):
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(less_known_sites)')}
+    for column in ('latitude', 'longitude'):
+        if column not in columns:
+            conn.execute(f'ALTER TABLE less_known_sites ADD COLUMN {column} REAL')
+
+
+def _create_geocode_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            query TEXT PRIMARY KEY,
+            lat REAL,
+            lon REAL,
+            found INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+
+def _index_sensor_data(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sensors_site_date_hour
+        ON collected_data_from_sensors (site_name, date, hour)
+    ''')
+
+
+def _unique_sensor_readings(conn):
+    # one reading per site and hour, keep the latest row of any duplicates so
+    # bulk uploads can upsert on (site_name, date, hour)
+    conn.execute('''
+        DELETE FROM collected_data_from_sensors
+        WHERE id NOT IN (
+            SELECT MAX(id) FROM collected_data_from_sensors GROUP BY site_name, date, hour
+        )
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_sensors_site_date_hour')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sensors_site_date_hour
+        ON collected_data_from_sensors (site_name, date, hour)
+    ''')
+
+
+def _create_route_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS route_cache (
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            polyline BLOB NOT NULL,
+            corridor TEXT,
+            sites_version INTEGER,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (origin, destination)
+        ) WITHOUT ROWID
+    ''')
+    # sites_version changes with every write to less_known_sites, from any process,
+    # which tells cached route corridors they are out of date
+    conn.execute('CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO app_meta (key, value) VALUES ('sites_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS less_known_sites_{event.lower()}_version
+            AFTER {event} ON less_known_sites
+            BEGIN
+                UPDATE app_meta SET value = value + 1 WHERE key = 'sites_version';
+            END
+        ''')
+
+
+def _create_crowd_forecast(conn):
+    # hourly forecast per site and day, materialized by crowd_heatmap.CrowdHeatmap
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS crowd_forecast (
+            site_key TEXT NOT NULL,
+            date TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            count REAL,
+            level TEXT,
+            computed_at REAL NOT NULL,
+            PRIMARY KEY (site_key, date, hour)
+        ) WITHOUT ROWID
+    ''')
+    # sites with sensor readings written since their forecast was last computed, from any process
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS crowd_forecast_dirty (
+            site_name TEXT PRIMARY KEY,
+            changed_at REAL NOT NULL
+        )
+    ''')
+    for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS sensors_{event.lower()}_crowd_forecast
+            AFTER {event} ON collected_data_from_sensors
+            BEGIN
+                INSERT INTO crowd_forecast_dirty (site_name, changed_at) VALUES ({row}.site_name, julianday('now'))
+                ON CONFLICT(site_name) DO UPDATE SET changed_at = excluded.changed_at;
+            END
+        ''')
+
+
+# Schema history, MIGRATIONS[i] brings the database from user_version i to i + 1.
+# Only ever append to this list. The first steps use IF NOT EXISTS because
+# databases created before migrations existed already have those tables.
+MIGRATIONS = [
+    _create_base_tables,
+    _add_site_coordinates,
+    _create_geocode_cache,
+    _index_sensor_data,
+    _unique_sensor_readings,
+    _create_route_cache,
+    _create_crowd_forecast,
+]
+
+
+class Database:
+    """SQLite access with one persistent connection per thread.
+
+    Opening a connection and applying the pragmas costs more than most of our
+    queries, so each thread keeps its connection for its whole life instead of
+    reconnecting in every helper.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        conn.row_factory = sqlite3.Row  # This allows accessing columns by name
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """The calling thread's connection, rolled back if the block left a transaction open"""
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def schema_version(self):
+        return self.get_connection().execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        """Apply pending migrations, returns the number applied"""
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        applied = 0
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            while True:
+                # BEGIN IMMEDIATE takes the write lock, so two workers starting at
+                # the same time can't run the same migration twice
+                conn.execute("BEGIN IMMEDIATE")
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version >= len(MIGRATIONS):
+                    conn.execute("COMMIT")
+                    break
+                try:
+                    MIGRATIONS[version](conn)
+                    conn.execute(f'PRAGMA user_version = {version + 1}')
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                applied += 1
+        finally:
+            conn.close()
+        return applied
@@ -1,6 +1,10 @@
-from app import add_site, init_database, add_sensor_data, delete_site, clear_sites_table
+import argparse
+import sys
+import time
 
-init_database()
+from app import (add_site, init_database, add_sensor_data, delete_site, clear_sites_table, configure_logging,
+                 ingest_sensor_data)
+from sensor_ingest import read_csv, read_ndjson
 
 lesser_known_sites = [
     ("Jabal al-Qalaa", "Historical Site", "Ancient citadel in Amman with Roman ruins and panoramic city views."),
@@ -32,12 +36,52 @@ people_count = [
     # Add more rows here
 ]
 '''
-clear_sites_table()
-for name, category, desc in lesser_known_sites:
-    success, msg = add_site(name, category, desc)
-    print(f'{name} : {msg}')
 
-'''
-for date, hour, site_name, count in people_count:
-    success,msg = add_sensor_data(date, hour, site_name, count)
-    print(f'count in {site_name} on {date} at {hour}: {count}, message: {msg}')'''
\ No newline at end of file
+
+def fill_sites():
+    clear_sites_table()
+    for name, category, desc in lesser_known_sites:
+        success, msg = add_site(name, category, desc)
+        print(f'{name} : {msg}')
+
+    '''
+    for date, hour, site_name, count in people_count:
+        success,msg = add_sensor_data(date, hour, site_name, count)
+        print(f'count in {site_name} on {date} at {hour}: {count}, message: {msg}')'''
+
+
+def load_sensor_file(path, file_format=None):
+    """Bulk load sensor readings from a CSV or NDJSON file ('-' reads stdin)"""
+    if file_format is None:
+        file_format = 'csv' if path.lower().endswith('.csv') else 'ndjson'
+    reader = read_csv if file_format == 'csv' else read_ndjson
+
+    started = time.perf_counter()
+    if path == '-':
+        stats = ingest_sensor_data(reader(sys.stdin))
+    else:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            stats = ingest_sensor_data(reader(f))
+    elapsed = time.perf_counter() - started
+
+    print(f"{stats['written']} rows written, {stats['rejected']} rejected in {elapsed:.2f}s "
+          f"({stats['written'] / max(elapsed, 1e-9):.0f} rows/s)")
+    for error in stats['errors']:
+        print(f"  line {error['line']}: {error['error']}")
+    return stats
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Fill the tourism database")
+    arg_parser.add_argument('--sensors', metavar='FILE',
+                            help="bulk load sensor readings from a CSV or NDJSON file ('-' for stdin) instead of the sites")
+    arg_parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help="format of the sensor file, guessed from the extension by default")
+    args = arg_parser.parse_args()
+
+    configure_logging()
+    init_database()
+    if args.sensors:
+        load_sensor_file(args.sensors, args.format)
+    else:
+        fill_sites()
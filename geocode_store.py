@@ -0,0 +1,159 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+NOT_FOUND = "not_found"  # marker kept in memory for negatively cached queries
+
+
+def normalize_query(site):
+    return site.lower().strip()
+
+
+class GeocodeStore:
+    """Persistent geocode cache shared by every worker process through SQLite.
+
+    Lookups hit an in-process dict first and fall back to the database, so a
+    coordinate resolved by one gunicorn worker is visible to the others. New
+    results are buffered and written in batches (write-behind) with one upsert
+    transaction, instead of rewriting a JSON file on every miss. Sites Google
+    could not find are remembered for negative_ttl seconds so they are not
+    requested again on every chat.
+    """
+
+    def __init__(self, db, batch_size=50, flush_interval=2.0, negative_ttl=24 * 3600):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.negative_ttl = negative_ttl
+        self._memory = {}  # query -> (lat, lon) or (NOT_FOUND, stored_at)
+        self._pending = {}  # query -> (lat, lon, found, updated_at) not yet written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._writer = None  # started by the first put()
+
+    def _remember(self, query, lat, lon, found, updated_at):
+        if found:
+            self._memory[query] = (lat, lon)
+        elif time.time() - updated_at < self.negative_ttl:
+            self._memory[query] = (NOT_FOUND, updated_at)
+
+    def get(self, site):
+        """Returns (hit, coords) where coords is (lat, lon) or None for a known miss"""
+        query = normalize_query(site)
+        with self._lock:
+            entry = self._memory.get(query)
+        if entry is not None:
+            if entry[0] != NOT_FOUND:
+                return True, entry
+            if time.time() - entry[1] < self.negative_ttl:
+                return True, None
+            with self._lock:
+                self._memory.pop(query, None)
+            return False, None
+
+        # another worker may have resolved it since we loaded
+        with self.db.connection() as conn:
+            row = conn.execute(
+                'SELECT lat, lon, found, updated_at FROM geocode_cache WHERE query = ?', (query,)
+            ).fetchone()
+        if row is None:
+            return False, None
+        lat, lon, found, updated_at = row
+        with self._lock:
+            self._remember(query, lat, lon, found, updated_at)
+        if found:
+            return True, (lat, lon)
+        if time.time() - updated_at < self.negative_ttl:
+            return True, None
+        return False, None
+
+    def put(self, site, coords):
+        """Store coordinates for site, coords=None caches a "not found" answer"""
+        query = normalize_query(site)
+        now = time.time()
+        lat, lon = coords if coords else (None, None)
+        found = 1 if coords else 0
+        with self._lock:
+            self._remember(query, lat, lon, found, now)
+            self._pending[query] = (lat, lon, found, now)
+            full = len(self._pending) >= self.batch_size
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, name="geocode-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write every buffered result in a single upsert transaction"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, {}
+            rows = [(query, lat, lon, found, updated_at) for query, (lat, lon, found, updated_at) in batch.items()]
+            try:
+                with self.db.connection() as conn, conn:
+                    conn.executemany('''
+                        INSERT INTO geocode_cache (query, lat, lon, found, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(query) DO UPDATE SET
+                            lat = excluded.lat, lon = excluded.lon,
+                            found = excluded.found, updated_at = excluded.updated_at
+                        WHERE excluded.updated_at >= geocode_cache.updated_at
+                    ''', rows)
+            except sqlite3.Error as e:
+                logger.error("Could not write geocode cache: %s", e)
+                with self._lock:
+                    # keep them for the next attempt, unless a newer answer came in meanwhile
+                    for query, value in batch.items():
+                        self._pending.setdefault(query, value)
+
+    def _write_behind(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def load_all(self):
+        """Load every stored coordinate into memory with a single query"""
+        with self.db.connection() as conn:
+            rows = conn.execute('SELECT query, lat, lon, found, updated_at FROM geocode_cache').fetchall()
+        with self._lock:
+            for query, lat, lon, found, updated_at in rows:
+                self._remember(query, lat, lon, found, updated_at)
+        return len(rows)
+
+    def import_json(self, path):
+        """One-off import of the old location_cache.json file"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as f:
+            legacy = json.load(f)
+        now = time.time()
+        rows = [(normalize_query(query), coords[0], coords[1], 1, now) for query, coords in legacy.items() if coords]
+        with self.db.connection() as conn, conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO geocode_cache (query, lat, lon, found, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+        return len(rows)
+
+    def warm(self, sites, resolve):
+        """Make sure every site has a stored answer, resolving the missing ones with resolve(site)"""
+        self.load_all()
+        missing = [site for site in sites if not self.get(site)[0]]
+        for site in missing:
+            try:
+                resolve(site)
+            except Exception as e:
+                logger.warning("Could not geocode %s while warming the cache: %s", site, e)
+        self.flush()
+        return len(missing)
@@ -0,0 +1,294 @@
+"""Admission control for the LLM: a concurrency cap, a bounded priority queue and request coalescing.
+
+A CPU-only Ollama host gets slower for everyone when it generates many answers
+at once, so at most max_concurrent calls run at a time and the rest wait in a
+queue of at most max_queue calls. A call that finds the queue full fails at
+once with LLMBusy, which the routes turn into a 503. Waiting calls are let
+through by priority: short CLASSIFY prompts (trip extraction, the off-topic
+check) before long GENERATE answers, oldest first within a priority.
+
+Identical non-streamed prompts that are in flight at the same time share one
+call, the others wait for its result without taking a slot. The cap is shared
+by the Flask threads and the ASGI event loop (run/arun, run_stream/arun_stream).
+
+    ASFAR_LLM_CONCURRENCY   calls generating at once (default 2, 0 for no limit)
+    ASFAR_LLM_QUEUE         calls allowed to wait for a slot (default 32)
+"""
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
+from telemetry import Counter
+
+CLASSIFY = 0
+GENERATE = 1
+PRIORITY_NAMES = {CLASSIFY: "classify", GENERATE: "generate"}
+
+DEFAULT_CONCURRENCY = 2
+DEFAULT_QUEUE = 32
+
+llm_rejected = Counter("asfar_llm_rejected_total", "LLM calls refused because the queue was full.", ("priority",))
+llm_coalesced = Counter("asfar_llm_coalesced_total", "LLM calls answered by an identical call in flight.")
+
+
+class LLMBusy(RuntimeError):
+    pass
+
+
+def prompt_key(params):
+    """Coalescing key of an LLM request"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class _Ticket:
+    """A call waiting for a slot, woken through a threading.Event or an asyncio future"""
+
+    def __init__(self, priority, seq, loop=None):
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+        self.loop = loop
+        self.event = threading.Event() if loop is None else None
+        self.future = loop.create_future() if loop is not None else None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def wake(self):
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class _HeldStream:
+    """Iterates a stream (sync or async) while holding a slot, freed once when it ends, is closed or dropped"""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    def _done(self):
+        if not self._released:
+            self._released = True
+            self._release()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:
+            self._done()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self._done()
+            raise
+
+    def close(self):
+        if hasattr(self._stream, "close"):
+            self._stream.close()
+        self._done()
+
+    async def aclose(self):
+        if hasattr(self._stream, "aclose"):
+            await self._stream.aclose()
+        self._done()
+
+    def __del__(self):
+        self._done()
+
+
+class LLMScheduler:
+    """Lets at most max_concurrent LLM calls run, queues up to max_queue more by priority"""
+
+    def __init__(self, max_concurrent=DEFAULT_CONCURRENCY, max_queue=DEFAULT_QUEUE):
+        self.max_concurrent = max_concurrent or None  # None: no limit
+        self.max_queue = max_queue
+        self._running = 0
+        self._waiting = []  # heap of _Ticket
+        self._seq = itertools.count()
+        self._inflight = {}  # prompt key -> Future of the call everyone with that key waits on
+        self._lock = threading.Lock()
+
+    def busy(self):
+        """True when a new call would be refused"""
+        with self._lock:
+            return self._full()
+
+    def _full(self):
+        return self.max_concurrent is not None and self._running >= self.max_concurrent \
+            and len(self._waiting) >= self.max_queue
+
+    def _enter(self, priority, loop=None):
+        """None when a slot was free, otherwise the ticket to wait on"""
+        with self._lock:
+            if self.max_concurrent is None or self._running < self.max_concurrent:
+                self._running += 1
+                return None
+            if len(self._waiting) >= self.max_queue:
+                llm_rejected.inc(PRIORITY_NAMES.get(priority, str(priority)))
+                raise LLMBusy(f"{self._running} LLM calls running and {len(self._waiting)} waiting")
+            ticket = _Ticket(priority, next(self._seq), loop)
+            heapq.heappush(self._waiting, ticket)
+            return ticket
+
+    def _leave(self):
+        """Hand the slot to the next waiting call, or free it"""
+        with self._lock:
+            if self._waiting:
+                ticket = heapq.heappop(self._waiting)
+                ticket.granted = True
+                ticket.wake()
+                return
+            self._running -= 1
+
+    def _abandon(self, ticket):
+        """A waiting call gave up (cancelled), give back its slot if it got one meanwhile"""
+        with self._lock:
+            if not ticket.granted:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                return
+        self._leave()
+
+    @contextmanager
+    def slot(self, priority=GENERATE):
+        ticket = self._enter(priority)
+        if ticket is not None:
+            ticket.event.wait()
+        try:
+            yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def aslot(self, priority=GENERATE):
+        ticket = self._enter(priority, asyncio.get_running_loop())
+        if ticket is not None:
+            try:
+                await ticket.future
+            except asyncio.CancelledError:
+                self._abandon(ticket)
+                raise
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def _join(self, key):
+        """(future, leader): the leader makes the call, everyone else waits on its future"""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                llm_coalesced.inc()
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def _settle(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run(self, call, priority=GENERATE, key=None):
+        """call() once a slot is free, or the result of an identical call in flight"""
+        if key is None:
+            with self.slot(priority):
+                return call()
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            with self.slot(priority):
+                result = call()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, result)
+        return result
+
+    async def arun(self, call, priority=GENERATE, key=None):
+        """Awaitable run(), call is a coroutine function"""
+        if key is None:
+            async with self.aslot(priority):
+                return await call()
+        future, leader = self._join(key)
+        if not leader:
+            # shielded, one waiter going away must not cancel the result the others wait for
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            async with self.aslot(priority):
+                result = await call()
+        except BaseException as e:
+            self._settle(key, future, error=e)
+            raise
+        self._settle(key, future, result)
+        return result
+
+    def run_stream(self, call, priority=GENERATE):
+        """Iterator from call(), holding a slot until it is exhausted or closed"""
+        ticket = self._enter(priority)
+        if ticket is not None:
+            ticket.event.wait()
+        try:
+            return _HeldStream(iter(call()), self._leave)
+        except BaseException:
+            self._leave()
+            raise
+
+    async def arun_stream(self, call, priority=GENERATE):
+        """Async iterator from await call(), holding a slot until it is exhausted or closed"""
+        ticket = self._enter(priority, asyncio.get_running_loop())
+        if ticket is not None:
+            try:
+                await ticket.future
+            except asyncio.CancelledError:
+                self._abandon(ticket)
+                raise
+        try:
+            return _HeldStream((await call()).__aiter__(), self._leave)
+        except BaseException:
+            self._leave()
+            raise
+
+    def stats(self):
+        with self._lock:
+            return {"running": self._running, "waiting": len(self._waiting), "coalescing": len(self._inflight),
+                    "max_concurrent": self.max_concurrent, "max_queue": self.max_queue}
+
+    def metric_lines(self):
+        stats = self.stats()
+        lines = ["# HELP asfar_llm_running LLM calls holding a slot.", "# TYPE asfar_llm_running gauge",
+                 f"asfar_llm_running {stats['running']}",
+                 "# HELP asfar_llm_waiting LLM calls queued for a slot.", "# TYPE asfar_llm_waiting gauge",
+                 f"asfar_llm_waiting {stats['waiting']}"]
+        return lines + llm_rejected.render() + llm_coalesced.render()
+
+
+def scheduler_from_env(environ=os.environ):
+    return LLMScheduler(int(environ.get("ASFAR_LLM_CONCURRENCY", DEFAULT_CONCURRENCY)),
+                        int(environ.get("ASFAR_LLM_QUEUE", DEFAULT_QUEUE)))
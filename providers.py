@@ -0,0 +1,441 @@
+"""External services behind one interface: geocoding, weather, routing and the LLM.
+
+The backend is picked with ASFAR_PROVIDERS:
+
+    live    call Google Maps, Open-Meteo and Ollama (default)
+    record  call them and save every request/response pair under ASFAR_FIXTURES_DIR
+    replay  answer from the saved fixtures, waiting ASFAR_REPLAY_LATENCY first
+    stub    answer with synthetic data, nothing leaves the process
+
+ASFAR_REPLAY_LATENCY is "recorded" (wait as long as the real call took), a
+number of milliseconds for every service, or per service like
+"llm=800,route=150,geocode=40,weather=60". In replay mode a request that was
+never recorded raises FixtureMissing, or gets a stub answer when
+ASFAR_REPLAY_MISS=stub.
+
+Every backend has a blocking request() for the Flask routes and an awaitable
+arequest() for the ASGI entry point (asgi.py). Streamed LLM answers come
+back as an iterator of chunks from request() and an async iterator from
+arequest(). LLM calls go through an llm_scheduler.LLMScheduler, whatever the
+backend, so the concurrency cap also applies to stubbed and replayed runs.
+
+ASFAR_LLM_KEEP_ALIVE is how long Ollama keeps llama3 loaded after a call (an
+Ollama duration like "30m", negative for as long as it runs). While it is
+loaded, calls that start with the same messages (prompts.SYSTEM_PROMPT) skip
+evaluating that prefix again.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+from llm_scheduler import CLASSIFY, GENERATE, prompt_key, scheduler_from_env
+from route_cache import encode_polyline
+from upstream import LLM_TIMEOUT, UpstreamClient, breakers
+
+logger = logging.getLogger(__name__)
+
+SERVICES = ("geocode", "weather", "route", "llm")
+URLS = {
+    "geocode": "https://maps.googleapis.com/maps/api/geocode/json",
+    "route": "https://maps.googleapis.com/maps/api/directions/json",
+    "weather": "https://api.open-meteo.com/v1/forecast",
+}
+GOOGLE_SERVICES = ("geocode", "route")
+FIXTURES_DIR = "fixtures"
+LLM_MODEL = "llama3"
+LLM_KEEP_ALIVE = "30m"
+
+
+class FixtureMissing(LookupError):
+    pass
+
+
+def fixture_key(service, params):
+    payload = json.dumps([service, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def parse_latency(value):
+    """ASFAR_REPLAY_LATENCY -> None (recorded latency) or {service: seconds}"""
+    value = (value or "recorded").strip().lower()
+    if value == "recorded":
+        return None
+    if "=" not in value:
+        return dict.fromkeys(SERVICES, float(value) / 1000)
+    latency = {}
+    for part in value.split(","):
+        service, ms = part.split("=")
+        latency[service.strip()] = float(ms) / 1000
+    return latency
+
+
+class LiveBackend:
+    """The real services, responses are plain JSON-compatible dicts.
+
+    HTTP calls go through upstream.UpstreamClient (pooled sessions, timeouts,
+    retries, circuit breakers), the LLM through one ollama client per mode with
+    a timeout and the "llm" circuit breaker.
+    """
+
+    offline = False
+
+    def __init__(self, google_maps_key=None, keep_alive=LLM_KEEP_ALIVE):
+        self.google_maps_key = google_maps_key
+        self.keep_alive = keep_alive
+        self.upstream = UpstreamClient()
+        self._ollama_sync = None
+        self._ollama = None  # ollama.AsyncClient, created on first use inside the event loop
+
+    def _query(self, service, params):
+        return dict(params, key=self.google_maps_key) if service in GOOGLE_SERVICES else params
+
+    def request(self, service, params):
+        if service == "llm":
+            return self._chat(params)
+        if service not in URLS:
+            raise ValueError(f"unknown service {service}")
+        return self.upstream.get(service, URLS[service], self._query(service, params))
+
+    def _chat_options(self, params):
+        kwargs = {"keep_alive": self.keep_alive}
+        if params.get("format"):
+            kwargs["format"] = params["format"]
+        if params.get("options"):
+            kwargs["options"] = params["options"]
+        return kwargs
+
+    def _chat(self, params):
+        import ollama
+
+        if self._ollama_sync is None:
+            self._ollama_sync = ollama.Client(timeout=LLM_TIMEOUT)
+        kwargs = self._chat_options(params)
+        with breakers["llm"].guard(_is_llm_outage):
+            if params.get("stream"):
+                stream = self._ollama_sync.chat(model=params["model"], messages=params["messages"], stream=True,
+                                                **kwargs)
+                return ({"message": {"content": chunk["message"]["content"]}} for chunk in stream)
+            response = self._ollama_sync.chat(model=params["model"], messages=params["messages"], **kwargs)
+        return {"message": {"role": "assistant", "content": response["message"]["content"]}}
+
+    async def arequest(self, service, params):
+        if service == "llm":
+            return await self._achat(params)
+        if service not in URLS:
+            raise ValueError(f"unknown service {service}")
+        return await self.upstream.aget(service, URLS[service], self._query(service, params))
+
+    async def _achat(self, params):
+        if self._ollama is None:
+            import ollama
+
+            self._ollama = ollama.AsyncClient(timeout=LLM_TIMEOUT)
+        kwargs = self._chat_options(params)
+        with breakers["llm"].guard(_is_llm_outage):
+            if params.get("stream"):
+                stream = await self._ollama.chat(model=params["model"], messages=params["messages"], stream=True,
+                                                 **kwargs)
+                return self._achat_chunks(stream)
+            response = await self._ollama.chat(model=params["model"], messages=params["messages"], **kwargs)
+        return {"message": {"role": "assistant", "content": response["message"]["content"]}}
+
+    @staticmethod
+    async def _achat_chunks(stream):
+        async for chunk in stream:
+            yield {"message": {"content": chunk["message"]["content"]}}
+
+    async def aclose(self):
+        await self.upstream.aclose()
+
+
+def _is_llm_outage(e):
+    # ollama.ResponseError below 500 is a bad request (unknown model, bad format), not a sick server
+    status = getattr(e, "status_code", None)
+    return status is None or status < 0 or status >= 500
+
+
+class RecordingBackend:
+    """Calls another backend and saves each exchange as <dir>/<service>/<key>.json"""
+
+    offline = False
+
+    def __init__(self, backend, fixtures_dir=FIXTURES_DIR):
+        self.backend = backend
+        self.fixtures_dir = fixtures_dir
+
+    def _save(self, service, params, response, elapsed):
+        directory = os.path.join(self.fixtures_dir, service)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, fixture_key(service, params) + ".json")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"request": params, "response": response, "elapsed": elapsed}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    def request(self, service, params):
+        started = time.perf_counter()
+        response = self.backend.request(service, params)
+        if params.get("stream"):
+            return self._record_stream(service, params, response, started)
+        self._save(service, params, response, time.perf_counter() - started)
+        return response
+
+    def _record_stream(self, service, params, chunks, started):
+        recorded = []
+        for chunk in chunks:
+            recorded.append(chunk)
+            yield chunk
+        self._save(service, params, recorded, time.perf_counter() - started)
+
+    async def arequest(self, service, params):
+        started = time.perf_counter()
+        response = await self.backend.arequest(service, params)
+        if params.get("stream"):
+            return self._arecord_stream(service, params, response, started)
+        self._save(service, params, response, time.perf_counter() - started)
+        return response
+
+    async def _arecord_stream(self, service, params, chunks, started):
+        recorded = []
+        async for chunk in chunks:
+            recorded.append(chunk)
+            yield chunk
+        self._save(service, params, recorded, time.perf_counter() - started)
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+
+class StubBackend:
+    """Synthetic answers shaped like the real ones, deterministic for a given request"""
+
+    offline = True
+
+    def __init__(self, latency=None, llm_json=None, llm_text=None):
+        self.latency = latency or {}
+        self.llm_json = llm_json or {"on_topic": True, "current_location": "Amman",
+                                     "visit_time": "10:00 AM", "destination": "Petra"}
+        self.llm_text = llm_text or ("Petra is expected to be moderately crowded at that time and the weather "
+                                     "looks clear. Consider stopping at a lesser-known site on the way.")
+
+    @staticmethod
+    def _coords(address):
+        # spread places over Jordan, the same address always lands on the same spot
+        h = zlib.crc32(address.lower().strip().encode("utf-8"))
+        return 29.5 + (h % 30000) / 10000, 35.0 + (h // 30000 % 30000) / 10000
+
+    def request(self, service, params):
+        delay = self.latency.get(service, 0)
+        if delay:
+            time.sleep(delay)
+        response = self._answer(service, params)
+        if params.get("stream"):
+            return iter(response)
+        return response
+
+    async def arequest(self, service, params):
+        delay = self.latency.get(service, 0)
+        if delay:
+            await asyncio.sleep(delay)
+        response = self._answer(service, params)
+        if params.get("stream"):
+            return _aiter_chunks(response, 0)
+        return response
+
+    async def aclose(self):
+        pass
+
+    def _answer(self, service, params):
+        if service == "geocode":
+            lat, lng = self._coords(params["address"])
+            return {"status": "OK", "results": [{"geometry": {"location": {"lat": lat, "lng": lng}}}]}
+        if service == "route":
+            start, end = self._coords(params["origin"]), self._coords(params["destination"])
+            points = [(start[0] + (end[0] - start[0]) * i / 20, start[1] + (end[1] - start[1]) * i / 20)
+                      for i in range(21)]
+            return {"status": "OK", "routes": [{"overview_polyline": {"points": encode_polyline(points)}}]}
+        if service == "weather":
+            from datetime import datetime, timedelta
+
+            start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            times = [(start + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M") for i in range(24 * 7)]
+            return {"hourly": {"time": times, "temperature_2m": [24.0] * len(times),
+                               "weathercode": [0] * len(times)}}
+        if service == "llm":
+            text = json.dumps(self.llm_json) if params.get("format") == "json" else self.llm_text
+            if params.get("stream"):
+                return [{"message": {"content": word + " "}} for word in text.split(" ")]
+            return {"message": {"role": "assistant", "content": text}}
+        raise ValueError(f"unknown service {service}")
+
+
+class ReplayBackend:
+    """Answers from recorded fixtures after a configurable delay"""
+
+    offline = True
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, latency=None, fallback=None):
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency  # None replays the recorded latency
+        self.fallback = fallback
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _load(self, service, params):
+        key = fixture_key(service, params)
+        with self._lock:
+            if key in self._cache:
+                return self._cache[key]
+        try:
+            with open(os.path.join(self.fixtures_dir, service, key + ".json"), encoding="utf-8") as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            fixture = None
+        with self._lock:
+            self._cache[key] = fixture
+        return fixture
+
+    def _delay(self, service, fixture):
+        if self.latency is None:
+            return fixture.get("elapsed", 0)
+        return self.latency.get(service, fixture.get("elapsed", 0))
+
+    def request(self, service, params):
+        fixture = self._load(service, params)
+        if fixture is None:
+            if self.fallback is not None:
+                return self.fallback.request(service, params)
+            raise FixtureMissing(f"no recorded {service} response for {params}")
+        delay = self._delay(service, fixture)
+        if params.get("stream"):
+            return self._replay_stream(fixture["response"], delay)
+        time.sleep(delay)
+        return fixture["response"]
+
+    @staticmethod
+    def _replay_stream(chunks, delay):
+        # spread the delay over the chunks, the way tokens arrive from the model
+        pause = delay / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(pause)
+            yield chunk
+
+    async def arequest(self, service, params):
+        fixture = self._load(service, params)
+        if fixture is None:
+            if self.fallback is not None:
+                return await self.fallback.arequest(service, params)
+            raise FixtureMissing(f"no recorded {service} response for {params}")
+        delay = self._delay(service, fixture)
+        if params.get("stream"):
+            return _aiter_chunks(fixture["response"], delay)
+        await asyncio.sleep(delay)
+        return fixture["response"]
+
+    async def aclose(self):
+        pass
+
+
+async def _aiter_chunks(chunks, delay):
+    pause = delay / max(len(chunks), 1)
+    for chunk in chunks:
+        await asyncio.sleep(pause)
+        yield chunk
+
+
+def _priority(priority, format):
+    # a JSON answer is a short classification, free text is a full answer
+    if priority is not None:
+        return priority
+    return CLASSIFY if format == "json" else GENERATE
+
+
+class Providers:
+    """What the app calls, whatever the backend behind it"""
+
+    def __init__(self, backend, scheduler=None):
+        self.backend = backend
+        self.scheduler = scheduler or scheduler_from_env()
+
+    @property
+    def offline(self):
+        return self.backend.offline
+
+    def geocode(self, address):
+        return self.backend.request("geocode", {"address": address})
+
+    def directions(self, origin, destination):
+        return self.backend.request("route", {"origin": origin, "destination": destination})
+
+    def hourly_forecast(self, lat, lon):
+        return self.backend.request("weather", {"latitude": lat, "longitude": lon,
+                                                "hourly": "temperature_2m,weathercode", "timezone": "auto"})
+
+    def chat(self, messages, format=None, priority=None):
+        """Raises LLMBusy when the LLM queue is full"""
+        params = {"model": LLM_MODEL, "messages": messages, "format": format}
+        return self.scheduler.run(lambda: self.backend.request("llm", params), _priority(priority, format),
+                                  key=prompt_key(params))
+
+    def chat_stream(self, messages, priority=GENERATE):
+        """Yields response chunks as {"message": {"content": token}}"""
+        params = {"model": LLM_MODEL, "messages": messages, "format": None, "stream": True}
+        return self.scheduler.run_stream(lambda: self.backend.request("llm", params), priority)
+
+    def warm_prefix(self, system_prompt):
+        """Have the LLM load and evaluate system_prompt now, generating a single token"""
+        params = {"model": LLM_MODEL, "messages": [{"role": "system", "content": system_prompt}],
+                  "format": None, "options": {"num_predict": 1}}
+        return self.scheduler.run(lambda: self.backend.request("llm", params), CLASSIFY)
+
+    # awaitable versions of the calls above, for the ASGI entry point
+
+    async def ageocode(self, address):
+        return await self.backend.arequest("geocode", {"address": address})
+
+    async def adirections(self, origin, destination):
+        return await self.backend.arequest("route", {"origin": origin, "destination": destination})
+
+    async def ahourly_forecast(self, lat, lon):
+        return await self.backend.arequest("weather", {"latitude": lat, "longitude": lon,
+                                                       "hourly": "temperature_2m,weathercode", "timezone": "auto"})
+
+    async def achat(self, messages, format=None, priority=None):
+        params = {"model": LLM_MODEL, "messages": messages, "format": format}
+        return await self.scheduler.arun(lambda: self.backend.arequest("llm", params), _priority(priority, format),
+                                         key=prompt_key(params))
+
+    async def achat_stream(self, messages, priority=GENERATE):
+        """Async iterator of response chunks"""
+        params = {"model": LLM_MODEL, "messages": messages, "format": None, "stream": True}
+        return await self.scheduler.arun_stream(lambda: self.backend.arequest("llm", params), priority)
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+
+def providers_from_env(google_maps_key=None, environ=os.environ):
+    mode = environ.get("ASFAR_PROVIDERS", "live").strip().lower()
+    fixtures_dir = environ.get("ASFAR_FIXTURES_DIR", FIXTURES_DIR)
+    latency = parse_latency(environ.get("ASFAR_REPLAY_LATENCY"))
+    keep_alive = environ.get("ASFAR_LLM_KEEP_ALIVE", LLM_KEEP_ALIVE)
+    if mode == "live":
+        backend = LiveBackend(google_maps_key, keep_alive)
+    elif mode == "record":
+        backend = RecordingBackend(LiveBackend(google_maps_key, keep_alive), fixtures_dir)
+    elif mode == "replay":
+        fallback = None
+        if environ.get("ASFAR_REPLAY_MISS", "error").strip().lower() == "stub":
+            fallback = StubBackend(latency)
+        backend = ReplayBackend(fixtures_dir, latency, fallback)
+    elif mode == "stub":
+        backend = StubBackend(latency)
+    else:
+        raise ValueError(f"ASFAR_PROVIDERS must be live, record, replay or stub, got '{mode}'")
+    logger.info("External services: %s", mode)
+    return Providers(backend)
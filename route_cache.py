@@ -0,0 +1,130 @@
+import json
+import time
+
+import numpy as np
+
+from caching import TTLCache
+
+ROUTE_TTL = 30 * 24 * 3600  # roads rarely change, refetch a route after a month
+
+
+def normalize_place(place):
+    """Cache key of an origin or destination, case and spacing don't matter"""
+    return " ".join(str(place).lower().split())
+
+
+def decode_polyline(encoded):
+    """Decode a Google encoded polyline into a float32 array of (lat, lon) rows.
+
+    See https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    """
+    values = []
+    value = shift = 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    # every value is a delta from the previous point, 1e-5 degree units
+    deltas = np.asarray(values[:len(values) // 2 * 2], dtype=np.int64).reshape(-1, 2)
+    return (np.cumsum(deltas, axis=0) / 1e5).astype(np.float32)
+
+
+def encode_polyline(points):
+    """Inverse of decode_polyline, for (lat, lon) pairs"""
+    chars = []
+    previous = np.zeros(2, dtype=np.int64)
+    for point in np.rint(np.asarray(points, dtype=np.float64) * 1e5).astype(np.int64):
+        for delta in point - previous:
+            value = ~(int(delta) << 1) if delta < 0 else int(delta) << 1
+            while value >= 0x20:
+                chars.append(chr((0x20 | (value & 0x1f)) + 63))
+                value >>= 5
+            chars.append(chr(value + 63))
+        previous = point
+    return "".join(chars)
+
+
+class RouteCache:
+    """Directions results persisted in the route_cache table.
+
+    A route is stored as its decoded overview polyline (float32 lat/lon pairs
+    in a BLOB) together with its corridor, the lesser-known sites ranked along
+    it as [(site name, km)]. The corridor remembers the sites_version it was
+    computed at; a trigger bumps that version on every change to
+    less_known_sites, and a corridor from an older version is reported as
+    stale so the caller recomputes it from the cached points.
+    """
+
+    def __init__(self, db, maxsize=1024, ttl=ROUTE_TTL):
+        self.db = db
+        self.ttl = ttl
+        self._memory = TTLCache(maxsize, ttl, name="routes")
+
+    def sites_version(self):
+        with self.db.connection() as conn:
+            row = conn.execute("SELECT value FROM app_meta WHERE key = 'sites_version'").fetchone()
+        return row[0] if row else 0
+
+    def _load(self, key):
+        with self.db.connection() as conn:
+            row = conn.execute(
+                'SELECT polyline, corridor, sites_version, created_at FROM route_cache '
+                'WHERE origin = ? AND destination = ?', key
+            ).fetchone()
+        if row is None or time.time() - row['created_at'] >= self.ttl:
+            return None
+        return {
+            "points": np.frombuffer(row['polyline'], dtype=np.float32).reshape(-1, 2),
+            "corridor": json.loads(row['corridor']) if row['corridor'] is not None else None,
+            "sites_version": row['sites_version'],
+        }
+
+    def get(self, origin, destination):
+        """(points, corridor) of a cached route, (None, None) on a miss.
+
+        corridor is None when it was never computed or the sites changed since.
+        """
+        key = (normalize_place(origin), normalize_place(destination))
+        entry = self._memory.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is None:
+                return None, None
+            self._memory.set(key, entry)
+        corridor = entry["corridor"]
+        if corridor is not None and entry["sites_version"] != self.sites_version():
+            corridor = None
+        return entry["points"], corridor
+
+    def put(self, origin, destination, points, corridor=None, sites_version=None):
+        key = (normalize_place(origin), normalize_place(destination))
+        points = np.ascontiguousarray(points, dtype=np.float32).reshape(-1, 2)
+        entry = {"points": points, "corridor": corridor, "sites_version": sites_version}
+        with self.db.connection() as conn, conn:
+            conn.execute('''
+                INSERT INTO route_cache (origin, destination, polyline, corridor, sites_version, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(origin, destination) DO UPDATE SET
+                    polyline = excluded.polyline, corridor = excluded.corridor,
+                    sites_version = excluded.sites_version, created_at = excluded.created_at
+            ''', key + (points.tobytes(), json.dumps(corridor) if corridor is not None else None,
+                        sites_version, time.time()))
+        self._memory.set(key, entry)
+
+    def set_corridor(self, origin, destination, corridor, sites_version):
+        """Store a recomputed corridor without touching the route or its age"""
+        key = (normalize_place(origin), normalize_place(destination))
+        with self.db.connection() as conn, conn:
+            conn.execute(
+                'UPDATE route_cache SET corridor = ?, sites_version = ? WHERE origin = ? AND destination = ?',
+                (json.dumps(corridor), sites_version) + key
+            )
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.set(key, dict(entry, corridor=corridor, sites_version=sites_version))
+
+    def stats(self):
+        return self._memory.stats()
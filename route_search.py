@@ -0,0 +1,78 @@
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+SITE_CHUNK = 4096  # sites per broadcast block, bounds memory at chunk x route segments
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km between points given in radians, broadcasts over arrays"""
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class SiteCatalog:
+    """Coordinates of the lesser-known sites held as NumPy arrays (in radians).
+
+    rank_along_route measures every site against every segment of a route in
+    one broadcast, so a suggestion costs a few array operations whatever the
+    size of the catalog.
+    """
+
+    def __init__(self, names, coords):
+        self.names = list(names)
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        self.lat = np.radians(coords[:, 0])
+        self.lon = np.radians(coords[:, 1])
+
+    def __len__(self):
+        return len(self.names)
+
+    def distances_to_route(self, route_points):
+        """Distance in km from every site to the closest point of the route polyline"""
+        route = np.radians(np.asarray(route_points, dtype=np.float64).reshape(-1, 2))
+        if len(self.names) == 0 or len(route) == 0:
+            return np.full(len(self.names), np.inf)
+        if len(route) == 1:
+            return haversine_km(self.lat, self.lon, route[0, 0], route[0, 1])
+
+        # project on a plane around the route (equirectangular), accurate enough
+        # for finding the closest point of a segment at the scale of a country
+        cos_ref = np.cos(route[:, 0].mean())
+        rx, ry = route[:, 1] * cos_ref, route[:, 0]
+        ax, ay = rx[:-1], ry[:-1]  # segment starts, shape (M,)
+        dx, dy = rx[1:] - ax, ry[1:] - ay
+        seg_len2 = dx * dx + dy * dy
+        seg_len2[seg_len2 == 0] = 1e-18  # repeated points, t becomes 0
+
+        result = np.empty(len(self.names))
+        for start in range(0, len(self.names), SITE_CHUNK):
+            lat = self.lat[start:start + SITE_CHUNK, None]  # shape (N, 1)
+            lon = self.lon[start:start + SITE_CHUNK, None]
+            px, py = lon * cos_ref, lat
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / seg_len2, 0.0, 1.0)  # (N, M)
+            cx, cy = ax + t * dx, ay + t * dy
+            planar2 = (px - cx) ** 2 + (py - cy) ** 2
+            best = planar2.argmin(axis=1)
+            rows = np.arange(len(best))
+            # exact great-circle distance to the closest point found on the plane
+            closest_lat = cy[rows, best]
+            closest_lon = cx[rows, best] / cos_ref
+            result[start:start + SITE_CHUNK] = haversine_km(lat[:, 0], lon[:, 0], closest_lat, closest_lon)
+        return result
+
+    def rank_along_route(self, route_points, max_km=None, exclude=()):
+        """Sites sorted by distance to the route as [(name, km), ...]"""
+        distances = self.distances_to_route(route_points)
+        order = np.argsort(distances, kind="stable")
+        excluded = {name.lower() for name in exclude}
+        ranked = []
+        for i in order:
+            km = float(distances[i])
+            if max_km is not None and km > max_km:
+                break
+            if not np.isfinite(km) or self.names[i].lower() in excluded:
+                continue
+            ranked.append((self.names[i], km))
+        return ranked
@@ -0,0 +1,115 @@
+import csv
+import json
+import math
+from datetime import datetime
+
+CHUNK_SIZE = 5000  # rows validated and written per transaction
+MAX_REPORTED_ERRORS = 20
+MAX_COUNT = 1_000_000  # people in an hour at one site, anything above is a sensor fault (and may not fit SQLite)
+
+UPSERT_SQL = '''
+    INSERT INTO collected_data_from_sensors (date, hour, site_name, count)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(site_name, date, hour) DO UPDATE SET count = excluded.count
+'''
+
+DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%d-%m-%Y")
+
+
+def normalize_date(value):
+    """Sensor dates are stored as YYYY-MM-DD"""
+    value = str(value).strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"invalid date '{value}'")
+
+
+def normalize_hour(value):
+    """Sensor hours are stored as HH:00, accepts 13, '13', '13:00' or '13:00:00'"""
+    text = str(value).strip()
+    hour = text.split(":")[0]
+    if not hour.isdigit() or not 0 <= int(hour) <= 23:
+        raise ValueError(f"invalid hour '{value}'")
+    return f"{int(hour):02d}:00"
+
+
+def normalize_sensor_row(record):
+    """(date, hour, site_name, count) ready for the database, raises ValueError when invalid"""
+    if not isinstance(record, dict):
+        raise ValueError("row must be an object")
+    missing = [key for key in ("date", "hour", "site_name", "count") if record.get(key) in (None, "")]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    site_name = str(record["site_name"]).strip()
+    if not site_name:
+        raise ValueError("empty site_name")
+    try:
+        count = float(record["count"])
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid count '{record['count']}'")
+    if not math.isfinite(count) or count < 0 or count != int(count):
+        raise ValueError(f"count must be a non-negative integer, got '{record['count']}'")
+    if count > MAX_COUNT:
+        raise ValueError(f"count must be at most {MAX_COUNT}, got '{record['count']}'")
+    return normalize_date(record["date"]), normalize_hour(record["hour"]), site_name, int(count)
+
+
+def read_ndjson(lines):
+    """Yields (line number, record) from newline-delimited JSON"""
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError:
+            yield line_no, None
+
+
+def read_csv(lines):
+    """Yields (line number, record) from CSV with a header row (date,hour,site_name,count)"""
+    reader = csv.DictReader(lines)
+    for record in reader:
+        if reader.fieldnames:
+            record = {key.strip().lower(): value for key, value in record.items() if key}
+        yield reader.line_num, record
+
+
+def ingest_sensor_records(db, records, chunk_size=CHUNK_SIZE, on_chunk=None):
+    """Validate and upsert (line number, record) pairs in chunks, one transaction per chunk.
+
+    Invalid rows are skipped and reported, the valid rows of the same chunk
+    are still written. Writing the same (site_name, date, hour) again replaces
+    its count, so re-sending a file is harmless. on_chunk(rows) is called after
+    every committed chunk with the rows it wrote.
+    """
+    stats = {"received": 0, "written": 0, "rejected": 0, "errors": []}
+
+    def write(chunk):
+        with db.connection() as conn, conn:
+            conn.executemany(UPSERT_SQL, chunk)
+        stats["written"] += len(chunk)
+        if on_chunk is not None:
+            on_chunk(chunk)
+
+    chunk = []
+    for line_no, record in records:
+        stats["received"] += 1
+        try:
+            if record is None:
+                raise ValueError("not valid JSON")
+            chunk.append(normalize_sensor_row(record))
+        except ValueError as e:
+            stats["rejected"] += 1
+            if len(stats["errors"]) < MAX_REPORTED_ERRORS:
+                stats["errors"].append({"line": line_no, "error": str(e)})
+            continue
+        if len(chunk) >= chunk_size:
+            write(chunk)
+            chunk = []
+    if chunk:
+        write(chunk)
+    return stats
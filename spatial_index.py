@@ -0,0 +1,162 @@
+import heapq
+import threading
+from math import cos, floor, radians
+
+import numpy as np
+
+from route_search import haversine_km
+
+KM_PER_DEGREE = 111.32
+
+
+class GeoGridIndex:
+    """In-memory grid index over site coordinates for radius and k-nearest queries.
+
+    The world is cut in cells of cell_deg x cell_deg degrees and every site is
+    kept in the cell that contains it, so adding, moving or removing a site only
+    touches one or two cells. A query visits the cells around the point and
+    measures exact haversine distances to the sites found there.
+    """
+
+    def __init__(self, cell_deg=0.1):
+        self.cell_deg = cell_deg
+        self.version = 0  # bumped on every change, lets callers cache derived data
+        self._cells = {}  # (row, col) -> set of site names
+        self._sites = {}  # site name -> dict with id, site_name, category, latitude, longitude
+        self._bounds_cache = None
+        self._lock = threading.RLock()
+
+    def _cell(self, lat, lon):
+        return floor(lat / self.cell_deg), floor(lon / self.cell_deg)
+
+    def __len__(self):
+        return len(self._sites)
+
+    def upsert(self, site):
+        """Add or move a site, site is a dict with at least site_name, latitude and longitude"""
+        with self._lock:
+            self._discard(site["site_name"])
+            if site.get("latitude") is None or site.get("longitude") is None:
+                self.version += 1
+                return
+            entry = dict(site)
+            self._sites[entry["site_name"]] = entry
+            self._cells.setdefault(self._cell(entry["latitude"], entry["longitude"]), set()).add(entry["site_name"])
+            self.version += 1
+
+    def remove(self, site_name):
+        with self._lock:
+            if self._discard(site_name):
+                self.version += 1
+
+    def _discard(self, site_name):
+        entry = self._sites.pop(site_name, None)
+        if entry is None:
+            return False
+        cell = self._cell(entry["latitude"], entry["longitude"])
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(site_name)
+            if not members:
+                del self._cells[cell]
+        return True
+
+    def rebuild(self, sites):
+        with self._lock:
+            self._cells.clear()
+            self._sites.clear()
+            for site in sites:
+                self.upsert(site)
+
+    def get(self, site_name):
+        with self._lock:
+            return self._sites.get(site_name)
+
+    def sites(self):
+        with self._lock:
+            return list(self._sites.values())
+
+    def _bounds(self):
+        """Row and column range of the occupied cells, cached until the index changes"""
+        if self._bounds_cache is None or self._bounds_cache[0] != self.version:
+            rows = [row for row, _ in self._cells]
+            cols = [col for _, col in self._cells]
+            self._bounds_cache = (self.version, (min(rows), max(rows), min(cols), max(cols)))
+        return self._bounds_cache[1]
+
+    def _ring(self, center, radius):
+        """Cells at Chebyshev distance `radius` from center"""
+        row, col = center
+        if radius == 0:
+            return [center]
+        cells = []
+        for dc in range(-radius, radius + 1):
+            cells.append((row - radius, col + dc))
+            cells.append((row + radius, col + dc))
+        for dr in range(-radius + 1, radius):
+            cells.append((row + dr, col - radius))
+            cells.append((row + dr, col + radius))
+        return cells
+
+    def _ring_cells(self, center, radius):
+        # far rings have more cells than the whole index, walk the occupied ones instead
+        if 8 * radius > len(self._cells):
+            row, col = center
+            return [cell for cell in self._cells if max(abs(cell[0] - row), abs(cell[1] - col)) == radius]
+        return self._ring(center, radius)
+
+    def _measure(self, lat, lon, names):
+        entries = [self._sites[name] for name in names]
+        if not entries:
+            return []
+        coords = np.radians([(e["latitude"], e["longitude"]) for e in entries])
+        dist = haversine_km(radians(lat), radians(lon), coords[:, 0], coords[:, 1])
+        return list(zip(dist.tolist(), entries))
+
+    def query(self, lat, lon, radius_km=None, k=None):
+        """Sites around (lat, lon) as [(distance_km, site), ...] sorted by distance.
+
+        radius_km limits the distance, k limits the number of results; at
+        least one of them must be given.
+        """
+        if radius_km is None and k is None:
+            raise ValueError("radius_km or k is required")
+        with self._lock:
+            if not self._sites:
+                return []
+            center = self._cell(lat, lon)
+            min_row, max_row, min_col, max_col = self._bounds()
+            # the width of a cell in km shrinks towards the poles, measure it at the
+            # highest latitude any visited cell can have so the ring bounds stay safe
+            top_lat = min(max(abs(lat), abs(min_row * self.cell_deg), abs((max_row + 1) * self.cell_deg)), 89.9)
+            cell_km = self.cell_deg * KM_PER_DEGREE * max(cos(radians(top_lat)), 1e-6)
+            # past this ring no cell holds any site
+            last_ring = max(abs(min_row - center[0]), abs(max_row - center[0]),
+                            abs(min_col - center[1]), abs(max_col - center[1]))
+            max_ring = last_ring
+            if radius_km is not None:
+                max_ring = min(int(radius_km // cell_km) + 1, last_ring)
+
+            best = []  # max-heap of the k closest so far, as (-distance, n, site)
+            found = []
+            counter = 0
+            for ring in range(max_ring + 1):
+                names = [name for cell in self._ring_cells(center, ring) for name in self._cells.get(cell, ())]
+                for dist, entry in self._measure(lat, lon, names):
+                    if radius_km is not None and dist > radius_km:
+                        continue
+                    counter += 1
+                    if k is None:
+                        found.append((dist, counter, entry))
+                    elif len(best) < k:
+                        heapq.heappush(best, (-dist, counter, entry))
+                    elif dist < -best[0][0]:
+                        heapq.heapreplace(best, (-dist, counter, entry))
+                # every site in a further ring is at least ring * cell_km away
+                if k is not None and len(best) == k and -best[0][0] <= ring * cell_km:
+                    break
+
+            if k is not None:
+                found = [(-neg, n, entry) for neg, n, entry in best]
+            found.sort(key=lambda item: (item[0], item[1]))
+            return [(dist, entry) for dist, _, entry in found]
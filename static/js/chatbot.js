@@ -5,10 +5,23 @@ class Chatbot {
         this.inputField = document.querySelector('.chat-input input');
         this.sendButton = document.querySelector('.chat-input button');
         this.isLoading = false;
+        this.sessionId = this.loadSessionId();
         
         this.init();
     }
     
+    // One conversation per tab, the server remembers the trip details given so far under this id
+    loadSessionId() {
+        let id = sessionStorage.getItem('chatSessionId');
+        if (!id) {
+            // randomUUID is only there on https and localhost
+            id = (window.crypto && crypto.randomUUID) ? crypto.randomUUID()
+                : Date.now().toString(36) + Math.random().toString(36).slice(2);
+            sessionStorage.setItem('chatSessionId', id);
+        }
+        return id;
+    }
+    
     init() {
         // Add event listeners
         this.sendButton.addEventListener('click', () => this.sendMessage());
@@ -34,30 +47,127 @@ class Chatbot {
         this.showLoading();
         
         try {
-            const response = await fetch('/chat', {
+            const response = await fetch('/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ message: message })
+                body: JSON.stringify({ message: message, session_id: this.sessionId })
             });
             
-            const data = await response.json();
-            
-            // Hide loading
-            this.hideLoading();
-            
-            if (data.status === 'success') {
-                this.addBotMessage(data.response);
-            } else {
-                this.addBotMessage("Sorry, I encountered an error. Please try again.");
+            if (!response.ok) {
+                // Refused (503 when the server is busy) or failed, asking /chat again would only add load
+                await this.showErrorResponse(response);
+                return;
             }
+            if (!response.body) {
+                // Streaming not available, ask for the whole answer at once
+                await this.sendMessageWithoutStreaming(message);
+                return;
+            }
+            
+            await this.readStream(response.body);
         } catch (error) {
             this.hideLoading();
             this.addBotMessage("Sorry, I'm having trouble connecting. Please check your internet connection and try again.");
+        } finally {
+            this.isLoading = false;
+        }
+    }
+    
+    async sendMessageWithoutStreaming(message) {
+        const response = await fetch('/chat', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({ message: message, session_id: this.sessionId })
+        });
+        
+        const data = await response.json();
+        
+        // Hide loading
+        this.hideLoading();
+        
+        if (data.status === 'success') {
+            this.addBotMessage(data.response);
+        } else {
+            this.addBotMessage(data.response || "Sorry, I encountered an error. Please try again.");
         }
     }
     
+    // Show the reply of a failed request, the server explains itself in data.response when it can
+    async showErrorResponse(response) {
+        let data = null;
+        try {
+            data = await response.json();
+        } catch (error) {
+            // not JSON, e.g. a proxy error page
+        }
+        this.hideLoading();
+        this.addBotMessage((data && data.response) || "Sorry, I encountered an error. Please try again.");
+    }
+    
+    // Read Server-Sent Events from /chat/stream and show tokens as they arrive
+    async readStream(body) {
+        const reader = body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let content = null;
+        let text = '';
+        
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            
+            // Events are separated by a blank line
+            let boundary;
+            while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+                const event = this.parseEvent(buffer.slice(0, boundary));
+                buffer = buffer.slice(boundary + 2);
+                if (!event) continue;
+                
+                if (event.type === 'error') {
+                    this.hideLoading();
+                    this.addBotMessage(event.data.response || "Sorry, I encountered an error. Please try again.");
+                    return;
+                }
+                if (event.type === 'done') {
+                    this.hideLoading();
+                    return;
+                }
+                if (event.data.token) {
+                    if (content === null) {
+                        // First token: replace the loading message with the answer
+                        this.hideLoading();
+                        this.isLoading = true; // still busy until the stream ends
+                        content = this.addBotMessage('');
+                    }
+                    text += event.data.token;
+                    content.textContent = text;
+                    this.scrollToBottom();
+                }
+            }
+        }
+        this.hideLoading();
+    }
+    
+    parseEvent(raw) {
+        let type = 'message';
+        const dataLines = [];
+        raw.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                type = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        // Comment-only events (keep-alives) carry no data
+        if (dataLines.length === 0) return null;
+        return { type: type, data: JSON.parse(dataLines.join('\n')) };
+    }
+    
     addUserMessage(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = 'message user';
@@ -80,6 +190,7 @@ class Chatbot {
         `;
         this.messagesContainer.appendChild(messageDiv);
         this.scrollToBottom();
+        return messageDiv.querySelector('.message-content');
     }
     
     showLoading() {
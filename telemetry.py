@@ -0,0 +1,160 @@
+"""Per-stage timing of the chat pipeline, exported in the Prometheus text format.
+
+Wrap a stage with `with span("weather"):` or decorate it with
+`@traced("weather")`. Every span feeds the asfar_stage_duration_seconds
+histogram and, when the "telemetry" logger is at DEBUG, logs one line with
+the request's trace id, the parent stage and the duration. Spans nest
+through a context variable, so a stage run on the lookup pool shows up under
+the stage that submitted it (submit with contextvars.copy_context().run).
+"""
+import contextvars
+import functools
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# seconds, from a cache hit to a slow LLM answer
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labelvalues, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for labelvalues, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {value}")
+        return lines
+
+
+stage_duration = Histogram("asfar_stage_duration_seconds", "Time spent in each chat pipeline stage.", ("stage",))
+stage_errors = Counter("asfar_stage_errors_total", "Pipeline stages that raised.", ("stage",))
+request_duration = Histogram("asfar_http_request_duration_seconds", "Time to respond to an HTTP request.",
+                             ("method", "endpoint", "status"))
+METRICS = [stage_duration, stage_errors, request_duration]
+
+
+def start_trace():
+    """Give the current request a fresh trace id, returns it"""
+    trace_id = uuid.uuid4().hex[:16]
+    _trace_id.set(trace_id)
+    return trace_id
+
+
+def current_trace():
+    return _trace_id.get()
+
+
+@contextmanager
+def span(stage):
+    parent = _current_stage.get()
+    token = _current_stage.set(stage)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_stage.reset(token)
+        stage_duration.observe(elapsed, stage)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("span trace=%s stage=%s parent=%s duration_ms=%.2f",
+                         _trace_id.get(), stage, parent, elapsed * 1000)
+
+
+def traced(stage):
+    """Decorator form of span()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cache_metrics(stats):
+    """Metric lines for TTLCache.stats() dicts"""
+    lines = []
+    for metric, key, kind, help_text in (
+        ("asfar_cache_hits_total", "hits", "counter", "Cache lookups that found a value."),
+        ("asfar_cache_misses_total", "misses", "counter", "Cache lookups that found nothing."),
+        ("asfar_cache_entries", "size", "gauge", "Entries currently held by a cache."),
+    ):
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+        lines += [f'{metric}{{cache="{_escape(s["name"])}"}} {s[key]}' for s in stats]
+    return lines
+
+
+def render_metrics(extra_lines=()):
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += list(extra_lines)
+    return "\n".join(lines) + "\n"
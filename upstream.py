@@ -0,0 +1,223 @@
+"""HTTP access to the upstream APIs: pooled connections, timeouts, retries and circuit breakers.
+
+Each service gets its own requests.Session, so calls to a host reuse
+keep-alive connections instead of paying a TCP and TLS handshake every time,
+with a (connect, read) timeout and retries with exponential backoff on
+connection errors, timeouts, 429 and 5xx answers. The async path shares one
+httpx.AsyncClient and retries the same way.
+
+Every service also has a circuit breaker. After BREAKER_FAILURES calls in a
+row have failed, calls fail at once with CircuitOpen for BREAKER_RESET
+seconds instead of tying up a worker on a service that is down; then a single
+trial call decides whether it closes again. Callers catch UpstreamError and
+fall back to cached or degraded answers.
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from telemetry import Counter
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) seconds, and how many times a failed call is tried again
+TIMEOUTS = {"geocode": (3.05, 4), "route": (3.05, 6), "weather": (3.05, 4)}
+RETRIES = {"geocode": 1, "route": 2, "weather": 1}
+BACKOFF = 0.3  # seconds before the first retry, doubled for each one after
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+POOL_SIZE = 32  # keep-alive connections per host, a little above the lookup pool's workers
+ASYNC_MAX_CONNECTIONS = 100  # the async client's limit, shared by every request in the process
+LLM_TIMEOUT = 120
+
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30  # seconds
+
+upstream_errors = Counter("asfar_upstream_errors_total", "Upstream calls that failed after retries.",
+                          ("service",))
+upstream_rejected = Counter("asfar_upstream_rejected_total", "Upstream calls refused by an open circuit.",
+                            ("service",))
+
+
+class UpstreamError(Exception):
+    """An upstream service did not answer usefully"""
+
+    def __init__(self, service, message):
+        super().__init__(f"{service}: {message}")
+        self.service = service
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+class CircuitBreaker:
+    """Closed until `failures` calls in a row fail, then open for `reset_timeout` seconds"""
+
+    def __init__(self, service, failures=BREAKER_FAILURES, reset_timeout=BREAKER_RESET):
+        self.service = service
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._failed = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return "closed" if self._opened_at is None else "open"
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            # once the reset timeout has passed one caller probes the service and the
+            # timeout starts over, so the rest keep failing fast until the probe succeeds
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                self._opened_at = now
+                return
+        upstream_rejected.inc(self.service)
+        raise CircuitOpen(self.service, "circuit open, service recently failing")
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit for %s closed", self.service)
+            self._failed = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failed += 1
+            if self._opened_at is not None:
+                self._opened_at = time.monotonic()  # the probe failed
+            elif self._failed >= self.failures:
+                logger.warning("Circuit for %s open after %s failures", self.service, self._failed)
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self, is_failure=lambda e: True):
+        """Run a call through the breaker, exceptions for which is_failure(e) is true count against it"""
+        self.before_call()
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        self.record_success()
+
+
+breakers = {service: CircuitBreaker(service) for service in ("geocode", "route", "weather", "llm")}
+
+
+def breaker_metrics():
+    """Metric lines with the state of every breaker, 1 when its circuit is open"""
+    lines = ["# HELP asfar_upstream_circuit_open Whether calls to a service are refused (1) or let through (0).",
+             "# TYPE asfar_upstream_circuit_open gauge"]
+    lines += [f'asfar_upstream_circuit_open{{service="{service}"}} {int(breaker.state == "open")}'
+              for service, breaker in breakers.items()]
+    return upstream_errors.render() + upstream_rejected.render() + lines
+
+
+def _is_outage(e):
+    """Failures that say the service is unwell, not that our request was wrong"""
+    import requests
+
+    if isinstance(e, requests.HTTPError):
+        return e.response is None or e.response.status_code in RETRY_STATUSES
+    return True
+
+
+def make_session(service):
+    # imported here, requests and urllib3 add a noticeable share of the app's import time
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=RETRIES[service], backoff_factor=BACKOFF, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(["GET"]), respect_retry_after_header=True, raise_on_status=False)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class UpstreamClient:
+    """GET JSON from an upstream service with a blocking or an awaitable call"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._http = None  # httpx.AsyncClient, created on first use inside the event loop
+
+    def _session(self, service):
+        with self._sessions_lock:
+            session = self._sessions.get(service)
+            if session is None:
+                session = self._sessions[service] = make_session(service)
+            return session
+
+    def get(self, service, url, params):
+        import requests
+
+        breaker = breakers[service]
+        try:
+            with breaker.guard(_is_outage):
+                response = self._session(service).get(url, params=params, timeout=TIMEOUTS[service])
+                response.raise_for_status()
+                return response.json()
+        except CircuitOpen:
+            raise
+        except (requests.RequestException, ValueError) as e:
+            upstream_errors.inc(service)
+            raise UpstreamError(service, repr(e)) from e
+
+    async def aget(self, service, url, params):
+        import httpx
+
+        if self._http is None:
+            self._http = httpx.AsyncClient(limits=httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS,
+                                                               max_keepalive_connections=POOL_SIZE))
+        connect, read = TIMEOUTS[service]
+        timeout = httpx.Timeout(read, connect=connect)
+        breaker = breakers[service]
+        breaker.before_call()
+        for attempt in range(RETRIES[service] + 1):
+            try:
+                response = await self._http.get(url, params=params, timeout=timeout)
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    data = response.json()
+                    breaker.record_success()
+                    return data
+                error = httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request,
+                                              response=response)
+            except httpx.HTTPStatusError as e:
+                # a 4xx other than 429 is our mistake, retrying or blaming the service won't help
+                breaker.record_success()
+                upstream_errors.inc(service)
+                raise UpstreamError(service, repr(e)) from e
+            except (httpx.TransportError, ValueError) as e:
+                error = e
+            if attempt < RETRIES[service]:
+                await asyncio.sleep(BACKOFF * 2 ** attempt)
+        breaker.record_failure()
+        upstream_errors.inc(service)
+        raise UpstreamError(service, repr(error)) from error
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()